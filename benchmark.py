@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The benchmark measures the pipeline stages, without caches or memory reports
+os.environ["PIPELINE_PROFILING"] = "1"
+os.environ["GSC_CACHE_ENABLED"] = "0"
+os.environ["MEMORY_REPORT_ENABLED"] = "0"
+
+import pandas as pd
+from profiling import profile_run
+from profiling import load_run_report
+from utils import use_local_gsheet
+from gsc import set_account_factory
+from gsc import get_gsc_data_df
+from gsc import GSC_MAX_WORKERS
+from click_tracking import get_click_data_df
+from pivoted_db import GEN_DB_DAG
+from synthetic_data import SyntheticScenario
+
+# Stored stage measurements the runs are compared against
+BENCHMARK_BASELINE_PATH = os.environ.get(
+    "BENCHMARK_BASELINE_PATH", "benchmarks/baseline.json"
+)
+# Stage measurements of the last benchmark
+BENCHMARK_REPORT_PATH = os.environ.get(
+    "BENCHMARK_REPORT_PATH", "reports/benchmark.json"
+)
+# Relative slowdown and memory growth over the baseline reported as regressions
+BENCHMARK_TIME_TOLERANCE = 0.25
+BENCHMARK_MEMORY_TOLERANCE = 0.10
+# Stages faster than this in the baseline are too noisy to compare their time
+BENCHMARK_MIN_SECONDS = 0.05
+
+
+def run_scenario(scenario, max_workers=GSC_MAX_WORKERS, latency=0.0):
+    """
+    Runs the pipeline once on the synthetic inputs of a scenario, fully offline.
+
+    Runs in a temporary working directory, so the datasets and reports the pipeline
+    writes never touch the real ones. The Search Console account is a fake serving
+    the scenario's rows, and the sheets are read from the generated CSV files.
+
+    Returns:
+        dict: The profiling report of the run.
+    """
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        os.chdir(directory)
+        try:
+            for name, path in scenario.write_gsheets("gsheet").items():
+                use_local_gsheet(name, path)
+            filter_rules_df = pd.read_csv("gsheet/filter_rules.csv")
+            set_account_factory(
+                lambda creds_path: scenario.make_account(creds_path, latency)
+            )
+
+            report_path = str(Path(directory) / "run_report.json")
+            with profile_run("benchmark", report_path):
+                gsc_df = get_gsc_data_df(max_workers=max_workers, qps=1e6)
+                click_data_df = get_click_data_df()
+                GEN_DB_DAG.run(
+                    {
+                        "gsc": gsc_df,
+                        "click_data": click_data_df,
+                        "filter_rules": filter_rules_df,
+                        "date_range_labels": None,
+                    },
+                    ["filter"],
+                    memoize=False,
+                )
+            return load_run_report(report_path)
+        finally:
+            set_account_factory(None)
+            os.chdir(working_dir)
+
+
+def summarize_runs(reports):
+    """
+    Returns the best measurements of each stage over several runs of a scenario.
+
+    Stages run more than once in a run get a "#n" suffix from their second call.
+    """
+    stages = {}
+    for report in reports:
+        total = {
+            "name": "total",
+            "depth": 0,
+            "rows_in": None,
+            "rows_out": None,
+            "wall_seconds": report["wall_seconds"],
+            "cpu_seconds": report["cpu_seconds"],
+            "peak_memory_bytes": report["peak_memory_bytes"],
+        }
+        calls = {}
+        for stage in report["stages"] + [total]:
+            calls[stage["name"]] = calls.get(stage["name"], 0) + 1
+            name = stage["name"]
+            if calls[name] > 1:
+                name = f"{name}#{calls[name]}"
+
+            best = stages.setdefault(name, dict(stage, name=name))
+            for measure in ["wall_seconds", "cpu_seconds", "peak_memory_bytes"]:
+                best[measure] = min(best[measure], stage[measure])
+
+    for stage in stages.values():
+        rows = max(stage["rows_in"] or 0, stage["rows_out"] or 0)
+        stage["rows_per_second"] = (
+            round(rows / stage["wall_seconds"])
+            if rows and stage["wall_seconds"]
+            else None
+        )
+    return stages
+
+
+def find_regressions(
+    stages,
+    baseline_stages,
+    time_tolerance=BENCHMARK_TIME_TOLERANCE,
+    memory_tolerance=BENCHMARK_MEMORY_TOLERANCE,
+):
+    """
+    Returns a description of every stage slower or using more memory than its baseline.
+    """
+    regressions = []
+    for name, baseline in baseline_stages.items():
+        stage = stages.get(name)
+        if stage is None:
+            continue
+
+        if baseline["wall_seconds"] >= BENCHMARK_MIN_SECONDS and stage[
+            "wall_seconds"
+        ] > baseline["wall_seconds"] * (1 + time_tolerance):
+            regressions.append(
+                f"{name}: {stage['wall_seconds']:.3f} s, "
+                f"baseline {baseline['wall_seconds']:.3f} s"
+            )
+        if baseline["peak_memory_bytes"] and stage["peak_memory_bytes"] > baseline[
+            "peak_memory_bytes"
+        ] * (1 + memory_tolerance):
+            regressions.append(
+                f"{name}: {stage['peak_memory_bytes'] / 1024**2:.1f} MB peak, "
+                f"baseline {baseline['peak_memory_bytes'] / 1024**2:.1f} MB"
+            )
+    return regressions
+
+
+def print_stages(scenario, stages):
+    stages_df = pd.DataFrame(stages.values())
+    stages_df["name"] = [
+        "  " * depth + name
+        for name, depth in zip(stages_df["name"], stages_df["depth"])
+    ]
+    stages_df["peak_memory_mb"] = (stages_df["peak_memory_bytes"] / 1024**2).round(1)
+    stages_df = stages_df.astype(
+        {"rows_in": "Int64", "rows_out": "Int64", "rows_per_second": "Int64"}
+    )
+    print(f"\n{scenario.name}")
+    print(
+        stages_df[
+            [
+                "name",
+                "wall_seconds",
+                "cpu_seconds",
+                "peak_memory_mb",
+                "rows_in",
+                "rows_out",
+                "rows_per_second",
+            ]
+        ].to_string(index=False)
+    )
+
+
+def load_baseline(path=BENCHMARK_BASELINE_PATH):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(data, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline on synthetic data, fully offline."
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10000, 100000],
+        help="Search Console rows of each scenario, e.g. 10000 100000 1000000 5000000",
+    )
+    parser.add_argument("--domains", type=int, default=5)
+    parser.add_argument("--countries", type=int, default=4)
+    parser.add_argument(
+        "--click-rows",
+        type=int,
+        default=None,
+        help="Rows of each click tracking sheet, a tenth of --rows by default",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Keep the best of this many runs"
+    )
+    parser.add_argument("--max-workers", type=int, default=GSC_MAX_WORKERS)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake Search Console waits before every response",
+    )
+    parser.add_argument("--baseline", default=BENCHMARK_BASELINE_PATH)
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the baseline of their scenarios",
+    )
+    parser.add_argument(
+        "--time-tolerance", type=float, default=BENCHMARK_TIME_TOLERANCE
+    )
+    parser.add_argument(
+        "--memory-tolerance", type=float, default=BENCHMARK_MEMORY_TOLERANCE
+    )
+    parser.add_argument("--output", default=BENCHMARK_REPORT_PATH)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    baseline_path = Path(args.baseline).resolve()
+    baseline = load_baseline(baseline_path)
+
+    results = {}
+    regressions = []
+    missing_baselines = []
+    for rows in args.rows:
+        scenario = SyntheticScenario(
+            rows, args.domains, args.countries, args.click_rows, args.seed
+        )
+        reports = [
+            run_scenario(scenario, args.max_workers, args.latency)
+            for _ in range(args.repeat)
+        ]
+        stages = summarize_runs(reports)
+        print_stages(scenario, stages)
+        results[scenario.name] = {"stages": stages}
+
+        if args.update_baseline:
+            baseline[scenario.name] = {"stages": stages}
+        elif scenario.name in baseline:
+            regressions += [
+                f"{scenario.name} {regression}"
+                for regression in find_regressions(
+                    stages,
+                    baseline[scenario.name]["stages"],
+                    args.time_tolerance,
+                    args.memory_tolerance,
+                )
+            ]
+        else:
+            missing_baselines.append(scenario.name)
+
+    save_json(results, args.output)
+    if args.update_baseline:
+        save_json(baseline, baseline_path)
+        print(f"\nBaseline updated: {baseline_path}")
+
+    if regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+    # Without a baseline nothing was compared, which must not pass as a clean run
+    if missing_baselines:
+        print(
+            f"\nNo baseline in {baseline_path} for: {', '.join(missing_baselines)}. "
+            "Store one with --update-baseline.",
+            file=sys.stderr,
+        )
+    return 1 if regressions or missing_baselines else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,43 @@
+import os
 import country_converter as coco
 from searchconsole import authenticate
 from pathlib import Path
 import pandas as pd
-import tldextract
-import pandas as pd
-import tldextract
 from tqdm import tqdm
 import pycountry_convert as pc
-from utils import download_gsheet
+from utils import register_gsheet
+from utils import fetch_gsheet
 from serpclix_tracking import process_click_tracking_data_serpclix
 from in_house_tracking import process_in_house_link_clicking_df
 from utils import add_domain_tld_column
+from utils import extract_domains
 from utils import add_date_range_column_and_clean
 from utils import get_date_ranges
+from utils import get_date_range_labels
+from utils import get_gsheet_hash
+from utils import compact_dtypes
+from utils import align_categories
+from utils import iter_csv_chunks
+from storage import write_dataset
+from profiling import profiled
+from storage import read_dataset
+from storage import read_dataset_inputs
+
+# Set CLICK_DATA_CHUNKED=0 to read the click tracking sheets in one piece
+CLICK_DATA_CHUNKED = os.environ.get("CLICK_DATA_CHUNKED", "1") == "1"
+# Keys the click counts are summed over
+CLICK_COUNT_KEYS = ["query", "country", "page", "date_range", "source"]
+# Click logs of the in-house clickers and of SerpClix
+IN_HOUSE_LINK_CLICKING_GSHEET = register_gsheet(
+    "in_house_link_clicking",
+    "https://docs.google.com/spreadsheets/d/124YEzAPOtR3UFT-KfG9IAWrcJr67icSPU475opYSaw8/edit#gid=1743911824",
+    "gsheet/in_house_link_clicking.csv",
+)
+SERPCLIX_LINK_CLICKING_GSHEET = register_gsheet(
+    "serpclix_link_clicking",
+    "https://docs.google.com/spreadsheets/d/186V5aIS4cNqhlFI_--0uqSQUMzrzjp_OtVCXZ1xVVoE/edit#gid=0",
+    "gsheet/serpclix_link_clicking.csv",
+)
 
 
 def count_in_house_clicks(click_data_df: pd.DataFrame) -> pd.DataFrame:
@@ -27,7 +52,7 @@ def count_in_house_clicks(click_data_df: pd.DataFrame) -> pd.DataFrame:
     """
     # Group the DataFrame by "Keyword", "Country", "Date", and "Source" and count the number of clicks
     in_house_clicks_df = click_data_df.groupby(
-        ["query", "country", "page", "date_range", "source"]
+        ["query", "country", "page", "date_range", "source"], observed=True
     )["page"].count()
 
     # Convert the Series to a DataFrame
@@ -60,7 +85,7 @@ def count_serpclix_clicks(click_data_df: pd.DataFrame) -> pd.DataFrame:
     """
     # Group the DataFrame by "Keyword", "Country", "Date", and "Source" and count the number of clicks
     inclix_df = click_data_df.groupby(
-        ["query", "country", "page", "date_range", "source"]
+        ["query", "country", "page", "date_range", "source"], observed=True
     )["page"].count()
 
     # Convert the Series to a DataFrame
@@ -88,7 +113,7 @@ def clean_date_range_df(click_data_df: pd.DataFrame) -> pd.DataFrame:
     """
     # Count all duplicate rows where "Keyword", "Country", "Date", and "Link" are the same and create a new column with the count named "simulated_clicks"
     click_data_df["simulated_clicks"] = click_data_df.groupby(
-        ["Keyword", "Country", "date_range", "Link"]
+        ["Keyword", "Country", "date_range", "Link"], observed=True
     )["Link"].transform("count")
 
     # Drop duplicates from the DataFrame based on the columns ["Keyword", "Country", "Date", "Link"]
@@ -103,9 +128,7 @@ def clean_date_range_df(click_data_df: pd.DataFrame) -> pd.DataFrame:
     click_data_df = click_data_df[click_data_df["date_range"] != "N/A"]
 
     # Create a new column "domain" with root domain + extension of the "Link" column using tldextract
-    click_data_df["domain"] = click_data_df["Link"].apply(
-        lambda link: tldextract.extract(link).registered_domain
-    )
+    click_data_df["domain"] = extract_domains(click_data_df["Link"], registered=True)
 
     # Split the column date_range into two columns "start_date" and "end_date" and drop the column "date_range"
     click_data_df[["start_date", "end_date"]] = click_data_df["date_range"].str.split(
@@ -153,8 +176,10 @@ def combine_source_columns(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: A DataFrame with the source_x and source_y columns combined into a single column named source.
     """
-    # combine source_x and source_y columns
-    df["source"] = df["source_x"].fillna("") + df["source_y"].fillna("")
+    # combine source_x and source_y columns, as strings since they can be categorical
+    df["source"] = df["source_x"].astype("string").fillna("") + df["source_y"].astype(
+        "string"
+    ).fillna("")
 
     # remove source_x and source_y columns
     df = df.drop(columns=["source_x", "source_y"])
@@ -173,8 +198,68 @@ def combine_source_columns(df: pd.DataFrame) -> pd.DataFrame:
 #     return df
 
 
+def reduce_click_counts(counts_dfs: list, count_column: str) -> pd.DataFrame:
+    """
+    Sums partial click counts of the same query, country, page, date range and source.
+
+    Args:
+        counts_dfs (list): DataFrames of partial counts, as returned by count_in_house_clicks or count_serpclix_clicks.
+        count_column (str): The name of the count column.
+
+    Returns:
+        pd.DataFrame: One row per key with the summed count, sorted by key like a single count would be.
+    """
+    counts_df = pd.concat(align_categories(*counts_dfs), ignore_index=True)
+    counts_df = counts_df.groupby(CLICK_COUNT_KEYS, observed=True, as_index=False)[
+        count_column
+    ].sum()
+    return compact_dtypes(counts_df)
+
+
+@profiled("count_clicks_in_chunks")
+def count_clicks_in_chunks(
+    csv_path: str,
+    process_function,
+    count_function,
+    count_column: str,
+    date_ranges: list,
+) -> pd.DataFrame:
+    """
+    Counts the clicks of a click tracking sheet chunk by chunk.
+
+    Every chunk is processed, bucketed into date ranges and counted on its own, and its
+    counts are summed into the running totals. Only one chunk of raw rows and the
+    counts are held in memory, however long the sheet grows.
+
+    Args:
+        csv_path (str): The path of the downloaded sheet.
+        process_function (callable): Cleans the raw rows of a chunk.
+        count_function (callable): Counts the clicks of a cleaned chunk.
+        count_column (str): The name of the count column.
+        date_ranges (list): The date ranges to bucket the clicks into.
+
+    Returns:
+        pd.DataFrame: The click counts of the whole sheet.
+    """
+    counts_df = None
+    for chunk_df in iter_csv_chunks(csv_path):
+        chunk_df = process_function(chunk_df)
+        chunk_df = add_date_range_column_and_clean(chunk_df, date_ranges)
+        chunk_counts_df = count_function(chunk_df)
+        if counts_df is not None:
+            chunk_counts_df = [counts_df, chunk_counts_df]
+        else:
+            chunk_counts_df = [chunk_counts_df]
+        counts_df = reduce_click_counts(chunk_counts_df, count_column)
+
+    if counts_df is None:
+        return pd.DataFrame(columns=CLICK_COUNT_KEYS + [count_column])
+    return counts_df
+
+
 def merge_inhouse_serpclix_dfs(df1, df2):
     # merge the two click tracking dataframes on 'query', 'country', 'page', 'date_range'
+    df1, df2 = align_categories(df1, df2)
     merged_click_tracking_df = pd.merge(
         df1,
         df2,
@@ -184,57 +269,97 @@ def merge_inhouse_serpclix_dfs(df1, df2):
     return merged_click_tracking_df
 
 
-def get_click_data_df() -> pd.DataFrame:
-    date_ranges = get_date_ranges()
-
-    # print(f"Date ranges:{date_ranges}")
-
-    in_house_link_clicking = "https://docs.google.com/spreadsheets/d/124YEzAPOtR3UFT-KfG9IAWrcJr67icSPU475opYSaw8/edit#gid=1743911824"
-    serpclix_link_clicking = "https://docs.google.com/spreadsheets/d/186V5aIS4cNqhlFI_--0uqSQUMzrzjp_OtVCXZ1xVVoE/edit#gid=0"
-
-    download_gsheet(in_house_link_clicking, "gsheet/in_house_link_clicking.csv")
-    download_gsheet(serpclix_link_clicking, "gsheet/serpclix_link_clicking.csv")
-
-    in_house_link_clicking_df = pd.read_csv(
-        "gsheet/in_house_link_clicking.csv", sep=",", encoding="utf-8"
-    )
-    serpclix_link_clicking_df = pd.read_csv(
-        "gsheet/serpclix_link_clicking.csv", sep=",", encoding="utf-8"
-    )
-
-    #### Manual Click Tracking Data Extraction
-
-    in_house_link_clicking_df = process_in_house_link_clicking_df(
-        in_house_link_clicking_df
-    )
-
-    in_house_link_clicking_df = add_date_range_column_and_clean(
-        in_house_link_clicking_df, date_ranges
-    )
-    in_house_link_clicking_df = count_in_house_clicks(in_house_link_clicking_df)
-
-    # save to csv
-    # in_house_link_clicking_df.to_csv(
-    #     "in_house_link_clicking.csv", index=False, sep="\t", encoding="utf-8"
-    # )
+@profiled("get_click_data_df")
+def get_click_data_df(chunked: bool = CLICK_DATA_CHUNKED) -> pd.DataFrame:
+    """
+    Downloads the click tracking sheets and counts the clicks of each query, page, country and date range.
 
-    #### Serpclix Click Tracking Data Extraction
+    Args:
+        chunked (bool): Read the sheets in chunks, keeping memory flat as they grow.
 
-    click_tracking_data_serpclix_df = process_click_tracking_data_serpclix(
-        serpclix_link_clicking_df, date_ranges
-    )
+    Returns:
+        pd.DataFrame: The in-house and SerpClix click counts.
+    """
+    date_ranges = get_date_ranges()
 
-    click_tracking_data_serpclix_df = add_date_range_column_and_clean(
-        click_tracking_data_serpclix_df, date_ranges
-    )
+    # print(f"Date ranges:{date_ranges}")
 
-    click_tracking_data_serpclix_df = count_serpclix_clicks(
-        click_tracking_data_serpclix_df
-    )
-    # save to csv
-    # click_tracking_data_serpclix_df.to_csv(
-    #     "serpclix_link_clicking.csv", index=False, sep="\t", encoding="utf-8"
-    # )
+    in_house_link_clicking_path = fetch_gsheet(IN_HOUSE_LINK_CLICKING_GSHEET)
+    serpclix_link_clicking_path = fetch_gsheet(SERPCLIX_LINK_CLICKING_GSHEET)
+
+    # Reuse the stored counts if neither sheet nor the date ranges changed since
+    inputs = {
+        "sheets": [
+            get_gsheet_hash(in_house_link_clicking_path),
+            get_gsheet_hash(serpclix_link_clicking_path),
+        ],
+        "date_ranges": get_date_range_labels(date_ranges),
+    }
+    if None not in inputs["sheets"] and read_dataset_inputs("click_data") == inputs:
+        stored_click_data_df = read_dataset("click_data")
+        if stored_click_data_df is not None:
+            print("Click tracking sheets unchanged, reusing the stored click data")
+            return stored_click_data_df
+
+    if chunked:
+        #### Click Tracking Data Extraction, one chunk of the sheets at a time
+        in_house_link_clicking_df = count_clicks_in_chunks(
+            in_house_link_clicking_path,
+            lambda df: process_in_house_link_clicking_df(df, stage=None),
+            count_in_house_clicks,
+            "in_house_clicks",
+            date_ranges,
+        )
+        click_tracking_data_serpclix_df = count_clicks_in_chunks(
+            serpclix_link_clicking_path,
+            lambda df: process_click_tracking_data_serpclix(
+                df, date_ranges, stage=None
+            ),
+            count_serpclix_clicks,
+            "serpclix_clicks",
+            date_ranges,
+        )
+    else:
+        in_house_link_clicking_df = pd.read_csv(
+            in_house_link_clicking_path, sep=",", encoding="utf-8"
+        )
+        serpclix_link_clicking_df = pd.read_csv(
+            serpclix_link_clicking_path, sep=",", encoding="utf-8"
+        )
+
+        #### Manual Click Tracking Data Extraction
+
+        in_house_link_clicking_df = process_in_house_link_clicking_df(
+            in_house_link_clicking_df
+        )
+
+        in_house_link_clicking_df = add_date_range_column_and_clean(
+            in_house_link_clicking_df, date_ranges
+        )
+        in_house_link_clicking_df = count_in_house_clicks(in_house_link_clicking_df)
+
+        # save to csv
+        # in_house_link_clicking_df.to_csv(
+        #     "in_house_link_clicking.csv", index=False, sep="\t", encoding="utf-8"
+        # )
+
+        #### Serpclix Click Tracking Data Extraction
+
+        click_tracking_data_serpclix_df = process_click_tracking_data_serpclix(
+            serpclix_link_clicking_df, date_ranges
+        )
+
+        click_tracking_data_serpclix_df = add_date_range_column_and_clean(
+            click_tracking_data_serpclix_df, date_ranges
+        )
+
+        click_tracking_data_serpclix_df = count_serpclix_clicks(
+            click_tracking_data_serpclix_df
+        )
+        # save to csv
+        # click_tracking_data_serpclix_df.to_csv(
+        #     "serpclix_link_clicking.csv", index=False, sep="\t", encoding="utf-8"
+        # )
     #### Merge Click Tracking Data
 
     merged_click_tracking_df = merge_inhouse_serpclix_dfs(
@@ -243,11 +368,15 @@ def get_click_data_df() -> pd.DataFrame:
     merged_click_tracking_df = combine_source_columns(merged_click_tracking_df)
 
     merged_click_tracking_df = add_domain_tld_column(merged_click_tracking_df)
+    merged_click_tracking_df = compact_dtypes(
+        merged_click_tracking_df, stage="click_data"
+    )
 
     # # save to csv
     # merged_click_tracking_df.to_csv(
     #     "merged_click_tracking_df.csv", index=False, sep="\t", encoding="utf-8"
     # )
+    write_dataset(merged_click_tracking_df, "click_data", inputs=inputs)
 
     return merged_click_tracking_df
 
@@ -0,0 +1,228 @@
+import hashlib
+import inspect
+import os
+import pickle
+from pathlib import Path
+
+import pandas as pd
+from profiling import profile_stage
+
+# Directory holding the memoized node outputs
+DAG_CACHE_DIR = os.environ.get("DAG_CACHE_DIR", "cache/dag")
+# Set DAG_CACHE_ENABLED=0 to always recompute every node
+DAG_CACHE_ENABLED = os.environ.get("DAG_CACHE_ENABLED", "1") == "1"
+# Bump to invalidate every memoized output, e.g. after upgrading pandas
+DAG_CACHE_VERSION = 1
+
+
+def hash_value(value) -> str:
+    """
+    Returns a sha256 of the content of a source value.
+
+    DataFrames are hashed from their columns, dtypes and row hashes, anything else
+    from its pickle.
+    """
+    digest = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        digest.update(
+            pickle.dumps((list(value.columns), [str(dtype) for dtype in value.dtypes]))
+        )
+        digest.update(
+            pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes()
+        )
+    else:
+        digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+
+def get_code_modules(function) -> list:
+    """
+    Returns the project modules whose code a function can run.
+
+    That is the module defining the function and, recursively, the modules defining
+    the project functions it references by name, like the helpers it calls. Only
+    modules in the directory of the function's own module are followed.
+    """
+    function = inspect.unwrap(function)
+    project_dir = Path(inspect.getfile(function)).resolve().parent
+    modules = {}
+    seen = set()
+    pending = [function]
+    while pending:
+        function = inspect.unwrap(pending.pop())
+        if function in seen:
+            continue
+        seen.add(function)
+        module = inspect.getmodule(function)
+        module_file = getattr(module, "__file__", None)
+        if module_file is None or Path(module_file).resolve().parent != project_dir:
+            continue
+        modules[module.__name__] = module
+
+        # Names used by the function and the functions nested in it
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            codes += [const for const in code.co_consts if inspect.iscode(const)]
+            for name in code.co_names:
+                value = function.__globals__.get(name)
+                if inspect.isfunction(value):
+                    pending.append(value)
+    return [modules[name] for name in sorted(modules)]
+
+
+def hash_code(function) -> str:
+    """
+    Returns a sha256 of the source code of the project modules a function can run,
+    see get_code_modules, or of its bytecode without source.
+
+    Hashing whole modules rather than the function alone means an edit to a helper
+    it calls, or to a module constant, changes the hash too.
+    """
+    digest = hashlib.sha256()
+    try:
+        for module in get_code_modules(function):
+            digest.update(inspect.getsource(module).encode("utf-8"))
+    except (OSError, TypeError):
+        digest.update(function.__code__.co_code)
+    return digest.hexdigest()
+
+
+class DagNode:
+    """
+    A step of a Dag: `function` is called with the outputs of `inputs`, in order.
+    """
+
+    def __init__(self, name, function, inputs, description=None, version=1):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.description = description or name
+        self.version = version
+
+
+class Dag:
+    """
+    Small DAG of pipeline steps with on-disk memoization of every node output.
+
+    A node's key hashes its name, version and code, the code of the helpers it calls
+    included, with the keys of its inputs. Source inputs are keyed by a hash of their
+    content. The key of a node only changes when something upstream changed, so a run
+    recomputes the nodes downstream of a changed input and loads the others from
+    disk, and only when their output is needed. Only the latest output of each node
+    is kept on disk. Nodes must not modify their inputs, which may be memoized
+    outputs of other nodes.
+    """
+
+    def __init__(self, cache_dir=DAG_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.nodes = {}
+
+    def add(self, name, function, inputs, description=None, version=1):
+        """
+        Adds a node. Its inputs must be sources or nodes added before it.
+        """
+        self.nodes[name] = DagNode(name, function, inputs, description, version)
+        return self
+
+    def _entry_path(self, name, key):
+        return self.cache_dir / f"{name}-{key}.pkl"
+
+    def _load(self, name, key):
+        try:
+            with open(self._entry_path(name, key), "rb") as file:
+                return True, pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False, None
+
+    def _store(self, name, key, value):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._entry_path(name, key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        # Keep only the latest output of the node
+        for old_path in self.cache_dir.glob(f"{name}-*.pkl"):
+            if old_path != path:
+                old_path.unlink(missing_ok=True)
+
+    def get_keys(self, sources):
+        """
+        Returns the key of every source and node reachable from the sources.
+        """
+        keys = {name: hash_value(value) for name, value in sources.items()}
+        for name, node in self.nodes.items():
+            if name in sources or any(
+                input_name not in keys for input_name in node.inputs
+            ):
+                continue
+            parts = [
+                str(DAG_CACHE_VERSION),
+                name,
+                str(node.version),
+                hash_code(node.function),
+            ]
+            parts += [keys[input_name] for input_name in node.inputs]
+            keys[name] = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+        return keys
+
+    def run(
+        self, sources, targets, memoize=DAG_CACHE_ENABLED, pbar=None, on_computed=None
+    ):
+        """
+        Computes the targets from the sources.
+
+        Args:
+            sources (dict): Input values by name. A source named like a node replaces
+                that node's output, so a run can start halfway through the DAG.
+            targets (list): The names of the nodes or sources to return.
+            memoize (bool): Load unchanged node outputs from disk and store the new ones.
+            pbar (stqdm, optional): The progress bar updated after every node.
+            on_computed (callable, optional): Called with the name and output of every
+                node that was computed rather than loaded.
+
+        Returns:
+            dict: The value of each target.
+        """
+        keys = self.get_keys(sources) if memoize else {}
+        values = dict(sources)
+        steps = {name: step for step, name in enumerate(self.nodes, start=1)}
+
+        def evaluate(name):
+            if name in values:
+                return values[name]
+            node = self.nodes[name]
+
+            if memoize:
+                found, value = self._load(name, keys[name])
+                if found:
+                    if pbar is not None:
+                        pbar.set_description(
+                            f"Step {steps[name]}: {node.description} (cached)"
+                        )
+                        pbar.update(1)
+                    values[name] = value
+                    return value
+
+            arguments = [evaluate(input_name) for input_name in node.inputs]
+            if pbar is not None:
+                pbar.set_description(f"Step {steps[name]}: {node.description}")
+            with profile_stage(name) as stage:
+                value = node.function(*arguments)
+                stage.set_rows(arguments, value)
+            if pbar is not None:
+                pbar.update(1)
+            if memoize:
+                self._store(name, keys[name], value)
+            if on_computed is not None:
+                on_computed(name, value)
+            values[name] = value
+            return value
+
+        outputs = {target: evaluate(target) for target in targets}
+        # Nodes that were neither needed nor changed count as done
+        if pbar is not None and pbar.total is not None and pbar.n < pbar.total:
+            pbar.update(pbar.total - pbar.n)
+        return outputs
@@ -0,0 +1,234 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from storage import list_partition_values
+from storage import read_dataset
+
+# Number of per-domain views kept in memory by each DomainIndex
+DOMAIN_VIEW_CACHE_SIZE = int(os.environ.get("DOMAIN_VIEW_CACHE_SIZE", "16"))
+# Comma-separated columns the dashboard filters by range, e.g. add "Average Position"
+DASHBOARD_FILTER_COLUMNS = [
+    column.strip()
+    for column in os.environ.get(
+        "DASHBOARD_FILTER_COLUMNS", "Adjusted Clicks,Impressions"
+    ).split(",")
+    if column.strip()
+]
+# Columns the dashboard table can be sorted by
+DASHBOARD_SORT_COLUMNS = ["Adjusted Clicks", "Impressions", "Average Position"]
+
+
+class ColumnIndex:
+    """
+    The values of a column in sorted order, with the row positions they come from.
+
+    A range query is two binary searches in the sorted values. Missing values are
+    left out of every range, and sort last in both directions.
+    """
+
+    def __init__(self, series):
+        self.values = series.to_numpy(dtype="float64", na_value=np.nan)
+        order = np.argsort(self.values, kind="stable")
+        valid = len(self.values) - int(np.isnan(self.values).sum())
+        # NaN sort last
+        self._orders = {True: order, False: None}
+        self.order = order[:valid]
+        self.sorted_values = self.values[self.order]
+        self.is_integer = pd.api.types.is_integer_dtype(series.dtype)
+        self.min = self.sorted_values[0] if valid else None
+        self.max = self.sorted_values[-1] if valid else None
+
+    def get_order(self, ascending=True):
+        """
+        Returns the positions of every row sorted by the column. Rows with the same
+        value keep their order, like a stable sort_values.
+        """
+        if self._orders[ascending] is None:
+            self._orders[ascending] = np.argsort(-self.values, kind="stable")
+        return self._orders[ascending]
+
+    def get_positions(self, low, high):
+        """
+        Returns the positions of the rows with a value between low and high, inclusive.
+        """
+        start = np.searchsorted(self.sorted_values, low, side="left")
+        stop = np.searchsorted(self.sorted_values, high, side="right")
+        return self.order[start:stop]
+
+
+class DomainView:
+    """
+    The rows of one domain, as rendered by the dashboard, with the column indexes of
+    its filterable columns.
+    """
+
+    def __init__(self, domain, df, filter_columns=DASHBOARD_FILTER_COLUMNS):
+        self.domain = domain
+        self.df = df
+        self.column_indexes = {
+            column: ColumnIndex(df[column])
+            for column in filter_columns
+            if column in df.columns
+        }
+
+    def get_column_index(self, column):
+        """
+        Returns the index of a column, building it on first use for the other columns.
+        """
+        if column not in self.column_indexes:
+            self.column_indexes[column] = ColumnIndex(self.df[column])
+        return self.column_indexes[column]
+
+    def get_positions(self, ranges):
+        """
+        Returns the sorted positions of the rows within every (low, high) range of
+        `ranges`, by column, or None when there is no range to filter on.
+
+        Each range is looked up in its column index, and the row positions are
+        intersected starting from the most selective column.
+        """
+        positions = sorted(
+            (
+                self.column_indexes[column].get_positions(low, high)
+                for column, (low, high) in ranges.items()
+            ),
+            key=len,
+        )
+        if not positions:
+            return None
+
+        selected = positions[0]
+        for column_positions in positions[1:]:
+            selected = np.intersect1d(selected, column_positions, assume_unique=True)
+        return np.sort(selected)
+
+    def filter_ranges(self, ranges):
+        """
+        Returns the rows within every range of `ranges` in their original order.
+        """
+        positions = self.get_positions(ranges)
+        return self.df if positions is None else self.df.iloc[positions]
+
+    def sort_positions(self, positions, column, ascending=True):
+        """
+        Returns row positions ordered by a column, from the presorted order of its index.
+
+        Args:
+            positions (np.ndarray): The positions to order, None for every row.
+            column (str): The column to sort by.
+            ascending (bool): Sort in ascending order.
+
+        Returns:
+            np.ndarray: The positions in sort order.
+        """
+        order = self.get_column_index(column).get_order(ascending)
+        if positions is None:
+            return order
+        selected = np.zeros(len(self.df), dtype=bool)
+        selected[positions] = True
+        return order[selected[order]]
+
+
+class DomainIndex:
+    """
+    The final table sorted by domain, with the row slice of every domain.
+
+    Rows keep their order within a domain. Looking up a domain is a dict lookup and
+    a slice instead of a mask over the whole table, and the views of the most
+    recently used domains are kept in a bounded LRU. The table is shared between
+    sessions and must not be modified.
+    """
+
+    def __init__(
+        self, df, domain_column="Domain", max_cached_views=DOMAIN_VIEW_CACHE_SIZE
+    ):
+        codes, domains = pd.factorize(df[domain_column].astype(object), sort=True)
+        # Stable, so the rows of a domain keep their order. Rows without a domain are dropped.
+        order = np.argsort(codes, kind="stable")
+        order = order[codes[order] >= 0]
+        self.df = df.iloc[order].reset_index(drop=True)
+
+        counts = np.bincount(codes[codes >= 0], minlength=len(domains))
+        stops = np.cumsum(counts)
+        starts = stops - counts
+        self.domains = [str(domain) for domain in domains]
+        self.slices = {
+            domain: slice(int(start), int(stop))
+            for domain, start, stop in zip(self.domains, starts, stops)
+        }
+
+        self.max_cached_views = max_cached_views
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, domain):
+        return domain in self.slices
+
+    def get_domain_df(self, domain):
+        """
+        Returns the rows of a domain, a slice of the sorted table.
+        """
+        return self.df.iloc[self.slices[domain]]
+
+    def get_view(self, domain):
+        """
+        Returns the view of a domain, from the LRU when it was used recently.
+        """
+        with self._lock:
+            view = self._views.get(domain)
+            if view is not None:
+                self._views.move_to_end(domain)
+                return view
+
+        view = DomainView(domain, self.get_domain_df(domain).reset_index(drop=True))
+        with self._lock:
+            self._views[domain] = view
+            self._views.move_to_end(domain)
+            while len(self._views) > self.max_cached_views:
+                self._views.popitem(last=False)
+        return view
+
+
+class StoredDomainIndex(DomainIndex):
+    """
+    The final table read from its Parquet dataset one domain at a time.
+
+    The domains are listed from the partition directories, and the rows of a domain are
+    read from its partition only when its view is first needed, so the whole table is
+    never loaded. The views of the most recently used domains are kept like in
+    DomainIndex.
+    """
+
+    def __init__(
+        self,
+        name="final",
+        domain_column="Domain",
+        max_cached_views=DOMAIN_VIEW_CACHE_SIZE,
+    ):
+        self.name = name
+        self.domain_column = domain_column
+        self.domains = list_partition_values(name, domain_column)
+        self._domain_set = set(self.domains)
+
+        self.max_cached_views = max_cached_views
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, domain):
+        return domain in self._domain_set
+
+    def get_domain_df(self, domain):
+        """
+        Returns the rows of a domain, read from its partition only.
+        """
+        df = read_dataset(self.name, filters={self.domain_column: domain})
+        # Only between the two renames of write_dataset swapping in a new table
+        if df is None:
+            raise KeyError(domain)
+        return df
@@ -0,0 +1,188 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Total size of the encoded exports kept in memory before the least recently used are evicted
+EXPORT_CACHE_MAX_BYTES = int(
+    os.environ.get("EXPORT_CACHE_MAX_BYTES", str(256 * 1024**2))
+)
+# Rows encoded at a time, so a large domain is never converted to text all at once
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", "50000"))
+# Rows of an Excel worksheet, header included
+XLSX_MAX_ROWS = 1048576
+
+
+def iter_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Yields the rows of a DataFrame in slices of `chunk_rows` rows, at least one slice.
+    """
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start : start + chunk_rows]
+
+
+def write_delimited(df, file, sep=","):
+    """
+    Writes a DataFrame as UTF-8 delimited text, one chunk of rows at a time.
+    """
+    for position, chunk in enumerate(iter_chunks(df)):
+        chunk.to_csv(file, sep=sep, index=False, header=position == 0, encoding="utf-8")
+
+
+def write_parquet(df, file):
+    """
+    Writes a DataFrame as Parquet, one row group per chunk of rows.
+    """
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(file, schema) as writer:
+        for chunk in iter_chunks(df):
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+
+
+def write_xlsx(df, file):
+    """
+    Writes a DataFrame as an Excel workbook with openpyxl in write-only mode, which
+    streams the rows to a temporary file instead of keeping every cell in memory.
+    """
+    if openpyxl is None:
+        raise ValueError("XLSX export needs openpyxl, install it with pip")
+    if len(df) + 1 > XLSX_MAX_ROWS:
+        raise ValueError(
+            f"{len(df)} rows do not fit in an Excel worksheet, export as CSV or Parquet"
+        )
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Report")
+    sheet.append([str(column) for column in df.columns])
+    for chunk in iter_chunks(df):
+        # Excel has no NaN, missing values are left empty
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for row in chunk.itertuples(index=False, name=None):
+            sheet.append(row)
+    workbook.save(file)
+
+
+# Export formats offered by the dashboard, by label
+EXPORT_FORMATS = {
+    "CSV": {
+        "extension": "csv",
+        "mime": "text/csv",
+        "writer": write_delimited,
+    },
+    "TSV": {
+        "extension": "tsv",
+        "mime": "text/tab-separated-values",
+        "writer": lambda df, file: write_delimited(df, file, sep="\t"),
+    },
+    "Parquet": {
+        "extension": "parquet",
+        "mime": "application/vnd.apache.parquet",
+        "writer": write_parquet,
+    },
+}
+if openpyxl is not None:
+    EXPORT_FORMATS["XLSX"] = {
+        "extension": "xlsx",
+        "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "writer": write_xlsx,
+    }
+
+
+def encode_export(df, export_format):
+    """
+    Returns the bytes of a DataFrame in one of the EXPORT_FORMATS.
+
+    Raises:
+        ValueError: When the rows do not fit the format.
+    """
+    buffer = io.BytesIO()
+    EXPORT_FORMATS[export_format]["writer"](df, buffer)
+    return buffer.getvalue()
+
+
+class ExportCache:
+    """
+    Size-bounded in-memory LRU cache of encoded exports.
+
+    Keys come from make_key: the version of the served dataset, the domain, the
+    filter ranges and the format, so a regeneration or another slider position
+    never serves stale bytes. An export bigger than the whole cache is not kept.
+    """
+
+    def __init__(self, max_bytes=EXPORT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(dataset_version, domain, ranges, export_format):
+        """
+        Returns the key of an export. `ranges` are the (low, high) filter ranges by
+        column, empty for the whole domain.
+        """
+        return (
+            dataset_version,
+            domain,
+            tuple(sorted((column, tuple(bounds)) for column, bounds in ranges.items())),
+            export_format,
+        )
+
+    def get(self, key):
+        """
+        Returns the cached bytes of an export, or None on a miss.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if len(data) > self.max_bytes:
+                return
+            if key in self._entries:
+                self.size_bytes -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.size_bytes += len(data)
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def get_or_encode(self, key, get_df, export_format):
+        """
+        Returns the cached bytes of an export, encoding the rows of `get_df()` on a miss.
+        """
+        data = self.get(key)
+        if data is None:
+            data = encode_export(get_df(), export_format)
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size_bytes,
+            }
@@ -1,16 +1,127 @@
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import country_converter as coco
 from searchconsole import authenticate
 from pathlib import Path
 import pandas as pd
-import tldextract
 from tqdm import tqdm
 from utils import get_date_ranges
-from utils import download_gsheet
-from country_converter import CountryConverter
+from utils import register_gsheet
+from utils import fetch_gsheet
 from utils import add_domain_tld_column
+from utils import extract_domains
+from utils import convert_countries
 from utils import add_date_range_column_and_clean
+from utils import compact_dtypes
+from utils import STRING_DTYPE
 from stqdm import stqdm
+from gsc_cache import GscResponseCache
+from gsc_cache import GSC_CACHE_ENABLED
+from gsc_cache import GSC_FINAL_AFTER_DAYS
+from gsc_cache import get_ttl_for_window
+from storage import write_dataset
+from storage import read_dataset
+from storage import delete_partitions
+from storage import list_partition_values
+from profiling import profiled
+from replay import REPLAY_MODE
+from replay import REPLAY_OFF
+from replay import REPLAY_RECORD
+from replay import REPLAY_REPLAY
+from replay import get_replay_account
+from replay import record_account
+
+# Number of worker threads used to query Search Console. 1 keeps the sequential path.
+GSC_MAX_WORKERS = int(os.environ.get("GSC_MAX_WORKERS", "4"))
+# Maximum Search Console queries per second shared by all workers
+GSC_QPS = float(os.environ.get("GSC_QPS", "5"))
+# Query every country of a property at once and split the rows locally
+GSC_SPLIT_COUNTRIES_LOCALLY = os.environ.get("GSC_SPLIT_COUNTRIES_LOCALLY", "1") == "1"
+# "window" runs one query per date range, "daily" fetches one span with the date
+# dimension and aggregates the date ranges locally from the daily facts
+GSC_FETCH_MODE = os.environ.get("GSC_FETCH_MODE", "window")
+# Number of days covered by each date range query
+GSC_WINDOW_DAYS = 28
+# Rows requested per Search Console page, the maximum the API allows
+GSC_PAGE_SIZE = 25000
+# Maximum rows fetched per query. Unset fetches every page.
+GSC_ROW_LIMIT = (
+    int(os.environ["GSC_ROW_LIMIT"]) if os.environ.get("GSC_ROW_LIMIT") else None
+)
+# Location of the per-query fetch report
+FETCH_REPORT_PATH = "gsc_data/fetch_report.csv"
+
+# Shared on-disk cache of Search Console responses, off while recording or replaying
+GSC_RESPONSE_CACHE = (
+    GscResponseCache() if GSC_CACHE_ENABLED and REPLAY_MODE == REPLAY_OFF else None
+)
+# Columns of the daily facts, stored in the "daily_facts" dataset
+DAILY_FACTS_COLUMNS = [
+    "web_property",
+    "query",
+    "page",
+    "country",
+    "date",
+    "clicks",
+    "impressions",
+    "position",
+]
+# Builds the accounts instead of authenticate_account when set, see set_account_factory
+_ACCOUNT_FACTORY = None
+
+# Sheet listing the domains and countries to fetch
+AHREFS_DOMAIN_GSHEET = register_gsheet(
+    "ahrefs_domain",
+    "https://docs.google.com/spreadsheets/d/1K7RfT4x8rjZyEN6M3pmwZspUpL1QFqnjsSgLQyqXFYs/edit#gid=437054005",
+    "gsheet/ahrefs_domain.csv",
+)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+
+    Tokens are refilled continuously at `rate` tokens per second up to `capacity`.
+    `acquire` blocks until the requested number of tokens is available, so a single
+    bucket shared between worker threads keeps the combined request rate under `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def set_account_factory(factory):
+    """
+    Replaces the Search Console authentication, e.g. with a fake account for offline runs.
+
+    Args:
+        factory (callable): Called with the credentials file path instead of
+            authenticate_account, returns the account. None restores the authentication.
+    """
+    global _ACCOUNT_FACTORY
+    _ACCOUNT_FACTORY = factory
 
 
 def authenticate_account(creds_path: str):
@@ -22,6 +133,11 @@ def authenticate_account(creds_path: str):
     Returns:
         authenticated account: An authenticated account object that can be used to make requests to the Search Console API.
     """
+    if _ACCOUNT_FACTORY is not None:
+        return _ACCOUNT_FACTORY(creds_path)
+    if REPLAY_MODE == REPLAY_REPLAY:
+        return get_replay_account()
+
     if Path(creds_path).is_file():
         account = authenticate(
             client_config="api/client_secrets.json", credentials=creds_path
@@ -31,6 +147,8 @@ def authenticate_account(creds_path: str):
             client_config="api/client_secrets.json", serialize=creds_path
         )
 
+    if REPLAY_MODE == REPLAY_RECORD:
+        account = record_account(account)
     return account
 
 
@@ -81,9 +199,7 @@ def gsc_viable_web_proprieties(viable_web_properties, ahrefs_domains_df):
     gsc_helper_df = pd.DataFrame(viable_web_properties, columns=["gsc_web_property"])
 
     # create a colum 'domain' that extracts the domain from the 'gsc_web_property' column using tldextract
-    gsc_helper_df["domain"] = gsc_helper_df["gsc_web_property"].apply(
-        lambda x: tldextract.extract(x).domain + "." + tldextract.extract(x).suffix
-    )
+    gsc_helper_df["domain"] = extract_domains(gsc_helper_df["gsc_web_property"])
 
     return gsc_helper_df
 
@@ -156,7 +272,224 @@ def explode_countries(data_frame):
     return exploded_df
 
 
-def get_gsc_dataframes(account, web_property, start_date, end_date, country):
+def filter_countries_locally(gsc_df, countries):
+    """
+    Keep only the GSC rows whose country is in the given list of ISO3 codes.
+
+    Args:
+        gsc_df (pandas.DataFrame): GSC rows with a lowercase ISO3 'country' column.
+        countries (list): The ISO3 country codes to keep.
+
+    Returns:
+        pandas.DataFrame: The rows for the requested countries.
+    """
+    if gsc_df.empty:
+        return gsc_df
+
+    countries = {str(country).strip().upper() for country in countries}
+    return gsc_df[gsc_df["country"].str.upper().isin(countries)]
+
+
+def iter_gsc_pages(
+    query,
+    fetch_report,
+    rate_limiter=None,
+    row_limit=GSC_ROW_LIMIT,
+    page_size=GSC_PAGE_SIZE,
+):
+    """
+    Execute a Search Console query page by page using startRow pagination.
+
+    Each page is yielded as a DataFrame as soon as it arrives, so callers can reduce
+    it before the next page is requested. `fetch_report` is updated in place with the
+    number of pages and rows fetched, and whether `row_limit` cut the query short.
+
+    Args:
+        query (searchconsole.query.Query): The query to execute.
+        fetch_report (dict): The report updated with 'pages', 'rows_fetched' and 'truncated'.
+        rate_limiter (TokenBucket, optional): Limiter acquired before every page request.
+        row_limit (int, optional): The maximum number of rows to fetch. None fetches everything.
+        page_size (int): The number of rows requested per page.
+
+    Yields:
+        pandas.DataFrame: The rows of each page.
+    """
+    fetch_report.setdefault("pages", 0)
+    fetch_report.setdefault("rows_fetched", 0)
+    fetch_report["truncated"] = False
+
+    while True:
+        rows_requested = page_size
+        if row_limit is not None:
+            rows_requested = min(page_size, row_limit - fetch_report["rows_fetched"])
+            if rows_requested <= 0:
+                # The last page was full, so more rows are available than the limit
+                fetch_report["truncated"] = True
+                return
+
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        report = query.limit(rows_requested, fetch_report["rows_fetched"]).execute()
+        if not report.rows:
+            return
+
+        fetch_report["pages"] += 1
+        fetch_report["rows_fetched"] += len(report.rows)
+        yield report.to_dataframe()
+
+        if len(report.rows) < rows_requested:
+            return
+
+
+def compact_gsc_page(page_df):
+    """
+    Convert the query and page columns of a page of rows to Arrow-backed strings.
+
+    The raw page holds one Python string object per query and page. The Arrow
+    strings are a fraction of that size, so a page is compacted before the next
+    page is requested.
+    """
+    return page_df.astype(
+        {column: STRING_DTYPE for column in ["query", "page"] if column in page_df}
+    )
+
+
+def fetch_gsc_rows(query, countries=None, rate_limiter=None, row_limit=GSC_ROW_LIMIT):
+    """
+    Fetch every page of a Search Console query, reducing each page as it arrives.
+
+    Every page is filtered by country and compacted before the next page is
+    requested. Only the compacted pages are kept until they are concatenated into
+    the result.
+
+    Args:
+        query (searchconsole.query.Query): The query to execute.
+        countries (list, optional): ISO3 codes to keep, filtered locally on each page.
+        rate_limiter (TokenBucket, optional): Limiter acquired before every page request.
+        row_limit (int, optional): The maximum number of rows to fetch. None fetches everything.
+
+    Returns:
+        tuple: The fetched rows as a DataFrame and the fetch report dict.
+    """
+    fetch_report = {"row_limit": row_limit}
+
+    pages_df = []
+    for page_df in iter_gsc_pages(query, fetch_report, rate_limiter, row_limit):
+        if countries is not None:
+            page_df = filter_countries_locally(page_df, countries)
+        pages_df.append(compact_gsc_page(page_df))
+
+    if pages_df:
+        gsc_df = pd.concat(pages_df, ignore_index=True)
+    else:
+        gsc_df = pd.DataFrame()
+    fetch_report["rows_kept"] = len(gsc_df)
+
+    return gsc_df, fetch_report
+
+
+def query_gsc_rows(
+    account,
+    web_property,
+    start_date,
+    end_date,
+    dimensions,
+    country=None,
+    countries=None,
+    rate_limiter=None,
+    row_limit=GSC_ROW_LIMIT,
+):
+    """
+    Fetch the rows of a Search Console query, serving them from GSC_RESPONSE_CACHE when possible.
+
+    The cache key covers the web property, dates, country filters, dimensions, search
+    type and row limit. The web property is only looked up on the account on a cache
+    miss, so a warm cache makes no API calls.
+
+    Args:
+        account (google.oauth2.service_account.Credentials): The GSC account credentials.
+        web_property (str): The web property to query.
+        start_date (str): The first day of the query.
+        end_date (str): The last day of the query.
+        dimensions (list): The dimensions to query.
+        country (str, optional): ISO3 code to filter on in the API.
+        countries (list, optional): ISO3 codes to keep, filtered locally on each page.
+        rate_limiter (TokenBucket, optional): Limiter acquired before every page request.
+        row_limit (int, optional): The maximum number of rows to fetch. None fetches every page.
+
+    Returns:
+        tuple: The fetched rows as a DataFrame and the fetch report dict.
+    """
+    cache_key = {
+        "web_property": web_property,
+        "start_date": start_date,
+        "end_date": end_date,
+        "country": country,
+        "countries": countries,
+        "dimensions": list(dimensions),
+        "search_type": "web",
+        "row_limit": row_limit,
+    }
+    if GSC_RESPONSE_CACHE is not None:
+        cached = GSC_RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+    query = (
+        account[web_property]
+        .query.search_type("web")
+        .range(start_date, end_date)
+        .dimension(*dimensions)
+    )
+    if country is not None:
+        query = query.filter("country", country, "equals")
+
+    gsc_df, fetch_report = fetch_gsc_rows(query, countries, rate_limiter, row_limit)
+
+    if GSC_RESPONSE_CACHE is not None:
+        GSC_RESPONSE_CACHE.put(
+            cache_key, (gsc_df, fetch_report), ttl=get_ttl_for_window(end_date)
+        )
+
+    return gsc_df, fetch_report
+
+
+def build_fetch_report(domains_df):
+    """
+    Collect the fetch reports attached to the GSC dataframes into a single DataFrame.
+    """
+    fetch_report_df = pd.DataFrame(
+        [df.attrs["fetch_report"] for df in domains_df if "fetch_report" in df.attrs]
+    )
+    if fetch_report_df.empty:
+        return fetch_report_df
+
+    truncated_df = fetch_report_df[fetch_report_df["truncated"]]
+    print(
+        f"Fetched {fetch_report_df['rows_fetched'].sum()} rows in "
+        f"{fetch_report_df['pages'].sum()} pages, "
+        f"{len(truncated_df)} of {len(fetch_report_df)} queries truncated"
+    )
+    for _, row in truncated_df.iterrows():
+        print(
+            f"Truncated at {row['row_limit']} rows: {row['web_property']} "
+            f"{row['start_date']} - {row['end_date']}"
+        )
+
+    return fetch_report_df
+
+
+def get_gsc_dataframes(
+    account,
+    web_property,
+    start_date,
+    end_date,
+    country=None,
+    countries=None,
+    rate_limiter=None,
+    row_limit=GSC_ROW_LIMIT,
+):
     """
     Get Google Search Console dataframes for a given account, date ranges, and web property.
     Performs a GSC query for each date range and appends start and end date columns.
@@ -166,28 +499,410 @@ def get_gsc_dataframes(account, web_property, start_date, end_date, country):
         account (google.oauth2.service_account.Credentials): The GSC account credentials.
         date_ranges (list): A list of date range tuples (start_date, end_date) to query.
         viable_gsc_domain (str): The viable web property to query.
+        country (str, optional): ISO3 code to filter on in the API. None queries every country.
+        countries (list, optional): ISO3 codes to keep after the query, filtered locally.
+        rate_limiter (TokenBucket, optional): Limiter acquired before every page request.
+        row_limit (int, optional): The maximum number of rows to fetch. None fetches every page.
     Returns:
         pandas.DataFrame: The concatenated and transformed GSC dataframes.
     """
-    web_property = account[web_property]
-
-    gsc_df = (
-        web_property.query.search_type("web")
-        .range(start_date, days=-28)
-        .dimension("query", "page", "country")
-        .filter("country", country, "equals")
-        .limit(25000)
-        .get()
-        .to_dataframe()
+    # Same days as .range(start_date, days=-28)
+    first_day, last_day = get_gsc_query_span(start_date)
+
+    gsc_df, fetch_report = query_gsc_rows(
+        account,
+        web_property,
+        first_day.strftime("%Y-%m-%d"),
+        last_day.strftime("%Y-%m-%d"),
+        ["query", "page", "country"],
+        country=country,
+        countries=countries,
+        rate_limiter=rate_limiter,
+        row_limit=row_limit,
     )
+
     gsc_df["start_date"] = start_date
     gsc_df["end_date"] = end_date
 
-    print(f"Number of rows: {len(gsc_df)}")
+    fetch_report.update(
+        web_property=web_property, start_date=start_date, end_date=end_date
+    )
+    gsc_df.attrs["fetch_report"] = fetch_report
+
+    print(
+        f"Number of rows: {len(gsc_df)} "
+        f"(fetched {fetch_report['rows_fetched']}, truncated: {fetch_report['truncated']})"
+    )
 
     return gsc_df
 
 
+def get_gsc_query_span(start_date, days=GSC_WINDOW_DAYS):
+    """
+    Return the first and last day covered by `.range(start_date, days=-days)`.
+
+    Args:
+        start_date (str): The date the query range is anchored on.
+        days (int): The number of days covered by the query.
+
+    Returns:
+        tuple: The first and last day of the query as pandas Timestamps.
+    """
+    last_day = pd.Timestamp(start_date).normalize()
+    first_day = last_day - pd.Timedelta(days=days - 1)
+    return first_day, last_day
+
+
+def get_gsc_daily_dataframes(
+    account,
+    web_property,
+    start_date,
+    end_date,
+    countries=None,
+    rate_limiter=None,
+    row_limit=GSC_ROW_LIMIT,
+):
+    """
+    Get daily Google Search Console facts for a web property between two dates.
+
+    Args:
+        account (google.oauth2.service_account.Credentials): The GSC account credentials.
+        web_property (str): The web property to query.
+        start_date (str): The first day to fetch.
+        end_date (str): The last day to fetch.
+        countries (list, optional): ISO3 codes to keep after the query, filtered locally.
+        rate_limiter (TokenBucket, optional): Limiter acquired before every page request.
+        row_limit (int, optional): The maximum number of rows to fetch. None fetches every page.
+
+    Returns:
+        pandas.DataFrame: One row per query, page, country and date.
+    """
+    daily_df, fetch_report = query_gsc_rows(
+        account,
+        web_property,
+        start_date,
+        end_date,
+        ["query", "page", "country", "date"],
+        countries=countries,
+        rate_limiter=rate_limiter,
+        row_limit=row_limit,
+    )
+
+    if daily_df.empty:
+        daily_df = pd.DataFrame(columns=DAILY_FACTS_COLUMNS)
+    else:
+        daily_df = daily_df.assign(web_property=web_property)[DAILY_FACTS_COLUMNS]
+
+    fetch_report.update(
+        web_property=web_property, start_date=start_date, end_date=end_date
+    )
+    daily_df.attrs["fetch_report"] = fetch_report
+
+    print(
+        f"Number of daily rows: {len(daily_df)} "
+        f"(fetched {fetch_report['rows_fetched']}, truncated: {fetch_report['truncated']})"
+    )
+
+    return daily_df
+
+
+def save_daily_facts(daily_df, daily_jobs):
+    """
+    Store the fetched daily facts so that date ranges can be recomputed without refetching.
+
+    The stored days of every job are replaced, so a day that no longer returns any row
+    does not keep its old facts.
+
+    Args:
+        daily_df (pandas.DataFrame): The daily facts fetched by the jobs.
+        daily_jobs (list): The daily jobs that were fetched.
+    """
+    for job in daily_jobs:
+        delete_partitions(
+            "daily_facts",
+            {
+                "web_property": job["web_property"],
+                "date": pd.date_range(job["start_date"], job["end_date"]).date.tolist(),
+            },
+        )
+    if not daily_df.empty:
+        daily_df = daily_df.assign(date=pd.to_datetime(daily_df["date"]).dt.date)
+        write_dataset(daily_df, "daily_facts", overwrite=False)
+
+
+def load_daily_facts(daily_jobs):
+    """
+    Load the stored daily facts of the web properties and days of daily jobs, or None if
+    none have been fetched yet.
+    """
+    if not daily_jobs:
+        return None
+    web_properties = list(dict.fromkeys(job["web_property"] for job in daily_jobs))
+    days = pd.date_range(
+        min(job["start_date"] for job in daily_jobs),
+        max(job["end_date"] for job in daily_jobs),
+    )
+    daily_df = read_dataset(
+        "daily_facts",
+        filters={"web_property": web_properties, "date": days.date.tolist()},
+        compact=False,
+    )
+    if daily_df is None:
+        return None
+    return daily_df.assign(date=pd.to_datetime(daily_df["date"]))
+
+
+def has_daily_facts():
+    """
+    Return whether any daily facts have been stored, without reading them.
+    """
+    return bool(list_partition_values("daily_facts", "web_property"))
+
+
+def aggregate_daily_facts(daily_df, windows, days=GSC_WINDOW_DAYS):
+    """
+    Aggregate daily facts into the same rows a date range query would return.
+
+    Every window covers the `days` days ending on its start date, matching
+    `.range(start_date, days=-days)`. Clicks and impressions are summed and the
+    position is averaged weighted by impressions, as Search Console does.
+
+    Args:
+        daily_df (pandas.DataFrame): The daily facts.
+        windows (list): A list of (start_date, end_date) tuples labelling each window.
+        days (int): The number of days covered by each window.
+
+    Returns:
+        pandas.DataFrame: One row per web property, query, page, country and window.
+    """
+    daily_df = daily_df.assign(
+        date=pd.to_datetime(daily_df["date"]),
+        weighted_position=daily_df["position"] * daily_df["impressions"],
+    )
+
+    windows_df = []
+    for start_date, end_date in windows:
+        first_day, last_day = get_gsc_query_span(start_date, days)
+        window_df = (
+            daily_df[daily_df["date"].between(first_day, last_day)]
+            .groupby(["web_property", "query", "page", "country"], sort=False)
+            .agg(
+                clicks=("clicks", "sum"),
+                impressions=("impressions", "sum"),
+                weighted_position=("weighted_position", "sum"),
+                mean_position=("position", "mean"),
+            )
+            .reset_index()
+        )
+        window_df["ctr"] = window_df["clicks"] / window_df["impressions"]
+        window_df["position"] = (
+            window_df["weighted_position"] / window_df["impressions"]
+        ).where(window_df["impressions"] > 0, window_df["mean_position"])
+        window_df["start_date"] = start_date
+        window_df["end_date"] = end_date
+        windows_df.append(window_df)
+
+    columns = [
+        "query",
+        "page",
+        "country",
+        "clicks",
+        "impressions",
+        "ctr",
+        "position",
+        "start_date",
+        "end_date",
+    ]
+    if not windows_df:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(windows_df, ignore_index=True)[columns]
+
+
+def build_gsc_daily_jobs(jobs, days=GSC_WINDOW_DAYS):
+    """
+    Turn date range jobs into one daily job per web property covering every window.
+
+    Args:
+        jobs (list): Jobs built by `build_gsc_jobs` with split_countries_locally=True.
+        days (int): The number of days covered by each window.
+
+    Returns:
+        tuple: The daily jobs and the list of (start_date, end_date) windows.
+    """
+    windows = list(dict.fromkeys((job["start_date"], job["end_date"]) for job in jobs))
+
+    daily_jobs = {}
+    for job in jobs:
+        first_day, last_day = get_gsc_query_span(job["start_date"], days)
+        daily_job = daily_jobs.setdefault(
+            job["web_property"],
+            {
+                "web_property": job["web_property"],
+                "start_date": first_day,
+                "end_date": last_day,
+                "countries": [],
+            },
+        )
+        daily_job["start_date"] = min(daily_job["start_date"], first_day)
+        daily_job["end_date"] = max(daily_job["end_date"], last_day)
+        for country in job["countries"]:
+            if country not in daily_job["countries"]:
+                daily_job["countries"].append(country)
+
+    for daily_job in daily_jobs.values():
+        daily_job["start_date"] = daily_job["start_date"].strftime("%Y-%m-%d")
+        daily_job["end_date"] = daily_job["end_date"].strftime("%Y-%m-%d")
+
+    return list(daily_jobs.values()), windows
+
+
+def build_incremental_daily_jobs(
+    daily_jobs, stored_df, final_after_days=GSC_FINAL_AFTER_DAYS
+):
+    """
+    Trim daily jobs to the days that are missing from the stored daily facts.
+
+    Stored days older than `final_after_days` before the last stored day are final and
+    are reused. Newer stored days may still have changed and are fetched again.
+
+    Args:
+        daily_jobs (list): Jobs built by `build_gsc_daily_jobs`.
+        stored_df (pandas.DataFrame): The stored daily facts.
+        final_after_days (int): The number of days after which Search Console data is final.
+
+    Returns:
+        tuple: The trimmed jobs and a list of the reused stored facts.
+    """
+    stored_df = stored_df.assign(date=pd.to_datetime(stored_df["date"]))
+
+    incremental_jobs = []
+    retained_df = []
+    for job in daily_jobs:
+        first_day = pd.Timestamp(job["start_date"])
+        last_day = pd.Timestamp(job["end_date"])
+        property_df = stored_df[stored_df["web_property"] == job["web_property"]]
+
+        # Fetch the whole span when the stored facts do not reach back to its first day
+        if property_df.empty or property_df["date"].min() > first_day:
+            incremental_jobs.append(job)
+            continue
+
+        refetch_from = max(
+            first_day,
+            property_df["date"].max() - pd.Timedelta(days=final_after_days - 1),
+        )
+        retained_df.append(
+            filter_countries_locally(
+                property_df[
+                    (property_df["date"] >= first_day)
+                    & (property_df["date"] < refetch_from)
+                ],
+                job["countries"],
+            )
+        )
+        if refetch_from <= last_day:
+            incremental_jobs.append(
+                {**job, "start_date": refetch_from.strftime("%Y-%m-%d")}
+            )
+
+    return incremental_jobs, retained_df
+
+
+def build_gsc_jobs(viable_gsc_domains_df, split_countries_locally=True):
+    """
+    Build the list of query jobs for `get_gsc_dataframes`.
+
+    When `split_countries_locally` is True, the rows are grouped by web property and
+    date range so that a single query returns every country, and the Ahrefs countries
+    are passed along to be filtered locally. Otherwise one job is built per country.
+
+    Args:
+        viable_gsc_domains_df (pandas.DataFrame): The viable web properties with
+            'web_property', 'start_date', 'end_date' and 'Country' columns.
+        split_countries_locally (bool): Whether to query all countries at once.
+
+    Returns:
+        list: A list of keyword argument dicts for `get_gsc_dataframes`.
+    """
+    lists_from_rows = extract_rows_as_lists(
+        viable_gsc_domains_df, ["web_property", "start_date", "end_date", "Country"]
+    )
+
+    if not split_countries_locally:
+        return [
+            {
+                "web_property": viable_gsc_domain[0],
+                "start_date": viable_gsc_domain[2],
+                "end_date": viable_gsc_domain[1],
+                "country": viable_gsc_domain[3],
+            }
+            for viable_gsc_domain in lists_from_rows
+        ]
+
+    # Group the countries by web property and date range, preserving order
+    grouped_countries = {}
+    for web_property, end_date, start_date, country in lists_from_rows:
+        countries = grouped_countries.setdefault(
+            (web_property, start_date, end_date), []
+        )
+        if country not in countries:
+            countries.append(country)
+
+    return [
+        {
+            "web_property": web_property,
+            "start_date": start_date,
+            "end_date": end_date,
+            "countries": countries,
+        }
+        for (web_property, start_date, end_date), countries in grouped_countries.items()
+    ]
+
+
+@profiled("fetch_gsc_dataframes")
+def fetch_gsc_dataframes_concurrently(
+    creds_path,
+    jobs,
+    max_workers=GSC_MAX_WORKERS,
+    qps=GSC_QPS,
+    fetch_function=get_gsc_dataframes,
+):
+    """
+    Run `fetch_function` (by default `get_gsc_dataframes`) for every job on a pool of worker threads.
+
+    The Google API client is not thread-safe, so every worker authenticates its own
+    account from `creds_path`. All workers share one TokenBucket limited to `qps`.
+
+    Args:
+        creds_path (str): The file path to the credentials file.
+        jobs (list): A list of keyword argument dicts for `get_gsc_dataframes`.
+        max_workers (int): The number of worker threads.
+        qps (float): The maximum number of queries per second across all workers.
+        fetch_function (callable): The function called with an account and each job.
+
+    Returns:
+        list: The dataframes in the same order as `jobs`.
+    """
+    rate_limiter = TokenBucket(qps)
+    thread_state = threading.local()
+
+    def fetch(job):
+        if not hasattr(thread_state, "account"):
+            thread_state.account = authenticate_account(creds_path)
+        return fetch_function(thread_state.account, rate_limiter=rate_limiter, **job)
+
+    domains_df = [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch, job): i for i, job in enumerate(jobs)}
+        for future in stqdm(
+            as_completed(futures), total=len(futures), desc="Extracting dataframes"
+        ):
+            domains_df[futures[future]] = future.result()
+
+    return domains_df
+
+
 def drop_fake_countries(df):
     # Filter out rows containing "zzz" or "xkk" in the "country" column
     df = df[~df["country"].str.contains("zzz|xkk")]
@@ -215,11 +930,8 @@ def convert_country_to_format(df, format="ISO2", column_name="country"):
     Returns:
     pandas.DataFrame: The updated DataFrame with the converted country names in the specified column.
     """
-    # Create a CountryConverter object
-    cc = CountryConverter()
-
-    # Use apply() method to convert country names to ISO2 codes
-    df[column_name] = df[column_name].apply(cc.convert, to=format)
+    # Convert every unique country name once
+    df[column_name] = convert_countries(df[column_name], to=format)
 
     return df
 
@@ -279,7 +991,9 @@ def extract_gsc_accounts_webproperty_list(account_list):
     Extract a list of web properties from a list of Google Search Console accounts.
     Removes duplicate web properties from the list.
     """
-    web_property_list = [account.url for account in account_list]
+    web_property_list = [
+        web_property.url for web_property in account_list.webproperties
+    ]
     # Remove duplicates from the list while preserving order
     web_property_list = list(dict.fromkeys(web_property_list))
     return web_property_list
@@ -311,9 +1025,7 @@ def create_gsc_webpropriety_df(gsc_webpropriety_list):
     )
 
     # Extract domain and extension from 'domain' column using tldextract library
-    gsc_webpropriety_df["domain"] = gsc_webpropriety_df["domain"].apply(
-        lambda x: tldextract.extract(x).domain + "." + tldextract.extract(x).suffix
-    )
+    gsc_webpropriety_df["domain"] = extract_domains(gsc_webpropriety_df["domain"])
 
     # Save the DataFrame to CSV file without index column
     # gsc_webpropriety_df.to_csv("gsc_webpropriety_df.csv", index=False)
@@ -363,9 +1075,33 @@ def convert_to_numbers(df):
     return df
 
 
-def get_gsc_data_df():
+@profiled("get_gsc_data_df")
+def get_gsc_data_df(
+    max_workers=GSC_MAX_WORKERS,
+    qps=GSC_QPS,
+    split_countries_locally=GSC_SPLIT_COUNTRIES_LOCALLY,
+    mode=GSC_FETCH_MODE,
+    incremental=False,
+    window_indices=None,
+):
+    """
+    Fetch the Google Search Console rows for every Ahrefs domain and date range.
+
+    Args:
+        max_workers (int): The number of worker threads. 1 queries sequentially.
+        qps (float): The maximum number of queries per second.
+        split_countries_locally (bool): Whether to query all countries at once.
+        mode (str): "window" for one query per date range, "daily" for the daily facts.
+        incremental (bool): In daily mode, only fetch the days missing from the stored facts.
+        window_indices (list, optional): Only fetch the date ranges at these indices.
+
+    Returns:
+        pandas.DataFrame: The cleaned GSC rows, or None if no domain was found in GSC.
+    """
     # Get date ranges
     date_ranges = get_date_ranges()
+    if window_indices is not None:
+        date_ranges = [date_ranges[i] for i in window_indices]
     # print(f"Date ranges: {date_ranges}")
 
     # Authenticate Google Search Console account
@@ -373,11 +1109,8 @@ def get_gsc_data_df():
     account = authenticate_account(creds_path)
 
     # Download domain list from Google Sheet
-    ahrefs_domains = "https://docs.google.com/spreadsheets/d/1K7RfT4x8rjZyEN6M3pmwZspUpL1QFqnjsSgLQyqXFYs/edit#gid=437054005"
-    download_gsheet(ahrefs_domains, "gsheet/ahrefs_domain.csv")
-
     ahrefs_domains_df = pd.read_csv(
-        "gsheet/ahrefs_domain.csv", sep=",", encoding="utf-8"
+        fetch_gsheet(AHREFS_DOMAIN_GSHEET), sep=",", encoding="utf-8"
     )
     ahrefs_domains_df = explode_countries(ahrefs_domains_df)
 
@@ -408,27 +1141,48 @@ def get_gsc_data_df():
     # save to csv
     # viable_gsc_domains_df.to_csv("viable_gsc_domains_df.csv", index=False)
 
-    lists_from_rows = extract_rows_as_lists(
-        viable_gsc_domains_df, ["web_property", "start_date", "end_date", "Country"]
-    )
+    # Build the query jobs for each viable web property and date range
+    retained_df = []
+    if mode == "daily":
+        jobs, windows = build_gsc_daily_jobs(build_gsc_jobs(viable_gsc_domains_df))
+        stored_df = load_daily_facts(jobs) if incremental else None
+        if stored_df is not None:
+            jobs, retained_df = build_incremental_daily_jobs(jobs, stored_df)
+        fetch_function = get_gsc_daily_dataframes
+    else:
+        jobs = build_gsc_jobs(viable_gsc_domains_df, split_countries_locally)
+        fetch_function = get_gsc_dataframes
 
     # Extract dataframes for each viable web property
-    domains_df = []
-    for viable_gsc_domain in stqdm(lists_from_rows, desc="Extracting dataframes"):
-        web_property = viable_gsc_domain[0]
-        start_date = viable_gsc_domain[2]
-        end_date = viable_gsc_domain[1]
-        country = viable_gsc_domain[3]
-        desc = f"Property: {web_property}, Start Date: {start_date}, End Date: {end_date}, Country: {country}"
-        domains_df.append(
-            get_gsc_dataframes(
-                account,
-                web_property=web_property,
-                start_date=start_date,
-                end_date=end_date,
-                country=country,
-            )
+    if max_workers > 1:
+        domains_df = fetch_gsc_dataframes_concurrently(
+            creds_path,
+            jobs,
+            max_workers=max_workers,
+            qps=qps,
+            fetch_function=fetch_function,
         )
+    else:
+        rate_limiter = TokenBucket(qps)
+        domains_df = []
+        for job in stqdm(jobs, desc="Extracting dataframes"):
+            domains_df.append(fetch_function(account, rate_limiter=rate_limiter, **job))
+
+    if GSC_RESPONSE_CACHE is not None:
+        print(f"GSC response cache: {GSC_RESPONSE_CACHE.stats()}")
+
+    # Report how many rows each query fetched and which ones were truncated
+    fetch_report_df = build_fetch_report(domains_df)
+    if not fetch_report_df.empty:
+        Path(FETCH_REPORT_PATH).parent.mkdir(parents=True, exist_ok=True)
+        fetch_report_df.to_csv(FETCH_REPORT_PATH, index=False)
+
+    # Store the daily facts and aggregate them into the date ranges locally
+    if mode == "daily" and len(domains_df) + len(retained_df) > 0:
+        if domains_df:
+            save_daily_facts(pd.concat(domains_df, ignore_index=True), jobs)
+        daily_df = pd.concat(retained_df + domains_df, ignore_index=True)
+        domains_df = [aggregate_daily_facts(daily_df, windows)]
 
     # Concatenate dataframes and drop duplicates
     if len(domains_df) > 0:
@@ -462,9 +1216,11 @@ def get_gsc_data_df():
         gsc_df = convert_to_numbers(gsc_df)
         gsc_df = combine_start_date_end_date(gsc_df)
         gsc_df = drop_start_date_end_date(gsc_df)
+        gsc_df = compact_dtypes(gsc_df, stage="gsc")
 
         # Save dataframe to csv
-    # gsc_df.to_csv("gsc_df.csv", index=False, sep="\t", encoding="utf-8")
+        # gsc_df.to_csv("gsc_df.csv", index=False, sep="\t", encoding="utf-8")
+        write_dataset(gsc_df, "gsc")
     else:
         print("Domains not found in GSC")
         gsc_df = None
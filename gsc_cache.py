@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# Directory holding the cached Search Console responses
+GSC_CACHE_DIR = os.environ.get("GSC_CACHE_DIR", "cache/gsc")
+# Maximum size of the cache on disk before the least recently used entries are evicted
+GSC_CACHE_MAX_BYTES = int(os.environ.get("GSC_CACHE_MAX_BYTES", str(512 * 1024**2)))
+# Set GSC_CACHE_ENABLED=0 to always query Search Console
+GSC_CACHE_ENABLED = os.environ.get("GSC_CACHE_ENABLED", "1") == "1"
+# Search Console data older than this many days is final and never expires
+GSC_FINAL_AFTER_DAYS = 4
+# Time to live of responses that include days Search Console may still update
+GSC_RECENT_TTL_SECONDS = 6 * 60 * 60
+
+
+def get_ttl_for_window(end_date, today=None):
+    """
+    Return the time to live in seconds for a query ending on `end_date`.
+
+    Windows that ended more than GSC_FINAL_AFTER_DAYS days ago are immutable and are
+    cached forever (None). More recent windows expire after GSC_RECENT_TTL_SECONDS.
+    """
+    today = pd.Timestamp.today().normalize() if today is None else today
+    if pd.Timestamp(end_date) <= today - pd.Timedelta(days=GSC_FINAL_AFTER_DAYS):
+        return None
+    return GSC_RECENT_TTL_SECONDS
+
+
+class GscResponseCache:
+    """
+    Size-bounded on-disk LRU cache for Search Console responses.
+
+    Every entry is pickled to its own file under `cache_dir`, and an `index.json`
+    keeps the size, expiry and last access time of each entry. Keys are dicts
+    describing the query shape and are hashed into file names.
+    """
+
+    def __init__(self, cache_dir=GSC_CACHE_DIR, max_bytes=GSC_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+
+    @staticmethod
+    def make_key(key_parts):
+        key = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _load_index(self):
+        if not self.index_path.is_file():
+            return {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._index, file)
+        os.replace(tmp_path, self.index_path)
+
+    def _entry_path(self, key):
+        return self.cache_dir / f"{key}.pkl"
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        try:
+            self._entry_path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        total_bytes = sum(entry["size"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_access"]):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= self._index[key]["size"]
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key_parts):
+        """
+        Return the cached value for `key_parts`, or None on a miss or expired entry.
+        """
+        key = self.make_key(key_parts)
+        with self._lock:
+            entry = self._index.get(key)
+            expired = (
+                entry is not None
+                and entry["expires_at"] is not None
+                and entry["expires_at"] < time.time()
+            )
+            if entry is None or expired:
+                if expired:
+                    self._remove(key)
+                    self._save_index()
+                self.misses += 1
+                return None
+
+            try:
+                with open(self._entry_path(key), "rb") as file:
+                    value = pickle.load(file)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self._remove(key)
+                self._save_index()
+                self.misses += 1
+                return None
+
+            entry["last_access"] = time.time()
+            self._save_index()
+            self.hits += 1
+            return value
+
+    def put(self, key_parts, value, ttl=None):
+        """
+        Store `value` under `key_parts`. A ttl of None never expires.
+        """
+        key = self.make_key(key_parts)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._entry_path(key).with_suffix(".tmp")
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+            os.replace(tmp_path, self._entry_path(key))
+
+            self._index[key] = {
+                "size": len(data),
+                "created": now,
+                "last_access": now,
+                "expires_at": None if ttl is None else now + ttl,
+            }
+            self._evict()
+            self._save_index()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": sum(entry["size"] for entry in self._index.values()),
+            }
@@ -1,5 +1,6 @@
-import country_converter as coco
 import pandas as pd
+from utils import convert_countries
+from utils import compact_dtypes
 
 
 # Constants
@@ -62,9 +63,8 @@ def convert_country_names_to_iso2(df):
     """
     Converts country names to ISO2 codes.
     """
-    # Convert all values from column Country into ISO2 codes
-    country_converter = coco.CountryConverter()
-    df.loc[:, "Country"] = df["Country"].apply(country_converter.convert, to="ISO2")
+    # Convert all values from column Country into ISO2 codes, once per unique value
+    df.loc[:, "Country"] = convert_countries(df["Country"], to="ISO2")
     return df
 
 
@@ -91,7 +91,7 @@ def rename_columns(df):
     return df
 
 
-def process_in_house_link_clicking_df(df):
+def process_in_house_link_clicking_df(df, stage="in_house_tracking"):
     """
     Processes click tracking data from in house source.
 
@@ -99,6 +99,8 @@ def process_in_house_link_clicking_df(df):
     -----------
     df : pandas.DataFrame
         The click tracking data as a pandas DataFrame.
+    stage : str, optional
+        The stage name of the memory report, None to skip the report.
 
     Returns:
         pd.DataFrame: A cleaned DataFrame containing only the "Keyword", "Country", "Date", "Link", and "Source" columns.
@@ -111,6 +113,7 @@ def process_in_house_link_clicking_df(df):
     df = convert_country_names_to_iso2(df)
     df = remove_empty_space_in_keyword_column(df)
     df = rename_columns(df)
+    df = compact_dtypes(df, stage=stage)
 
     # save to csv
     # df.to_csv("in_house_clicks.csv", index=False)
@@ -1,11 +1,28 @@
-from pivoted_db import gen_db_df
+import math
+import time
+
+# Start of this rerun of the script, for the profiling panel
+RERUN_STARTED = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
+from profiling import PROFILING_ENABLED
+from profiling import load_run_report
+from domain_index import DASHBOARD_FILTER_COLUMNS
+from domain_index import DASHBOARD_SORT_COLUMNS
+from regeneration import Regenerator
+from regeneration import REGENERATION_POLL_SECONDS
+from regeneration import SAVED_DATA_MAX_AGE_HOURS
+from export import ExportCache
+from export import EXPORT_FORMATS
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 
+# Page sizes of the paginated table
+PAGE_SIZES = [25, 50, 100, 250, 500]
+
 
 def get_credentials():
     SCOPES = ["https://www.googleapis.com/auth/webmasters.readonly"]
@@ -26,120 +43,301 @@ def get_credentials():
 
 
 # Define the function to generate the dataframe
-@st.cache_data
-def generate_dataframe():
-    """Generates the dataframe by calling the `gen_db_df()` function."""
-    return gen_db_df()
+@st.cache_resource
+def get_regenerator():
+    """Returns the regenerator of the domain index, shared by every session.
 
+    The last saved result is served right away. The dataframe is only regenerated in
+    the background when there is none, or when it is older than
+    SAVED_DATA_MAX_AGE_HOURS. The index is shared by every session and rerun without
+    being copied.
+    """
+    regenerator = Regenerator()
+    regenerator.load_saved()
+    if regenerator.is_data_older_than(SAVED_DATA_MAX_AGE_HOURS):
+        regenerator.request()
+    return regenerator
 
-@st.cache_data
-def convert_dataframe_to_csv(dataframe):
-    """Converts the given dataframe to a CSV file."""
-    return dataframe.to_csv(index=False, encoding="utf-8", sep="\t").encode("utf-8")
+
+@st.cache_resource
+def get_export_cache():
+    """Returns the cache of the encoded exports, shared by every session."""
+    return ExportCache()
 
 
 import streamlit as st
 
 
-def filter_dataframe_with_sliders(dataframe, *column_names):
-    """Filters the given dataframe based on selected ranges of multiple columns."""
-    ranges = []
+def select_ranges_with_sliders(domain_view, *column_names):
+    """Returns the ranges of multiple columns selected with sliders, by column.
+
+    The slider bounds come from the sorted column indexes of the view. A column left
+    at its full range, or collapsed to a single value, is not filtered.
+    """
+    ranges = {}
     for column_name in column_names:
-        # Get range values for the column
-        column_min_value = int(dataframe[column_name].min())
-        column_max_value = int(dataframe[column_name].max())
+        column_index = domain_view.column_indexes.get(column_name)
+        if column_index is None or column_index.min is None:
+            continue
+
+        # Get range values for the column, in tenths for the decimal columns
+        if column_index.is_integer:
+            column_min_value = int(column_index.min)
+            column_max_value = int(column_index.max)
+            step = 1
+        else:
+            column_min_value = math.floor(column_index.min * 10) / 10
+            column_max_value = math.ceil(column_index.max * 10) / 10
+            step = 0.1
 
         # If the minimum and maximum values are equal, don't filter on that column
         if column_min_value == column_max_value:
-            ranges.append((column_min_value, column_max_value))
-        else:
-            val_range = st.sidebar.slider(
-                f"{column_name.capitalize()} Range",
-                min_value=column_min_value,
-                max_value=column_max_value,
-                value=(column_min_value, column_max_value),
-            )
-            ranges.append(val_range)
-
-    # Filter dataframe based on selected slider ranges
-    filter_conditions = []
-    for i, column_name in enumerate(column_names):
-        if ranges[i][0] != ranges[i][1]:
-            filter_conditions.append(
-                dataframe[column_name].between(ranges[i][0], ranges[i][1])
+            continue
+        val_range = st.sidebar.slider(
+            f"{column_name.capitalize()} Range",
+            min_value=column_min_value,
+            max_value=column_max_value,
+            value=(column_min_value, column_max_value),
+            step=step,
+        )
+        if val_range[0] != val_range[1] and val_range != (
+            column_min_value,
+            column_max_value,
+        ):
+            ranges[column_name] = val_range
+
+    return ranges
+
+
+def show_paginated_table(domain_view, positions):
+    """Displays one page of the given rows of a domain view, sorted server-side.
+
+    Only the rows of the visible page are serialized and sent to the browser.
+    """
+    total_rows = len(domain_view.df) if positions is None else len(positions)
+    sort_column, sort_order, page_size_column, page_column = st.columns(4)
+    sort_by = sort_column.selectbox("Sort by", DASHBOARD_SORT_COLUMNS)
+    descending = sort_order.radio("Order", ["Descending", "Ascending"]) == "Descending"
+    page_size = page_size_column.selectbox("Rows per page", PAGE_SIZES, index=2)
+    page_count = max(1, math.ceil(total_rows / page_size))
+    page = page_column.number_input(
+        f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1
+    )
+
+    # Sort the row positions with the presorted column index, then take the page
+    positions = domain_view.sort_positions(positions, sort_by, ascending=not descending)
+    start = (page - 1) * page_size
+    page_positions = positions[start : start + page_size]
+
+    st.caption(
+        f"Rows {min(start + 1, total_rows)}-{start + len(page_positions)} "
+        f"of {total_rows}"
+    )
+    st.dataframe(domain_view.df.iloc[page_positions])
+
+
+def show_export_buttons(domain_view, ranges, data_version):
+    """Lets the rows of a domain view be downloaded as CSV, TSV, Parquet or XLSX.
+
+    An export is encoded when it is first prepared, then served from the export cache
+    until the dataframe is regenerated.
+    """
+    format_column, scope_column, button_column = st.columns(3)
+    export_format = format_column.selectbox("Export format", list(EXPORT_FORMATS))
+    filtered = (
+        scope_column.radio("Export rows", ["Filtered view", "Whole domain"])
+        == "Filtered view"
+    )
+    export_ranges = ranges if filtered else {}
+
+    export_cache = get_export_cache()
+    key = export_cache.make_key(
+        data_version, domain_view.domain, export_ranges, export_format
+    )
+    data = export_cache.get(key)
+    if data is None and button_column.button("Prepare export"):
+        try:
+            with st.spinner("Encoding the export"):
+                data = export_cache.get_or_encode(
+                    key,
+                    lambda: domain_view.filter_ranges(export_ranges),
+                    export_format,
+                )
+        except ValueError as error:
+            button_column.error(str(error))
+    if data is not None:
+        suffix = "_filtered" if export_ranges else ""
+        button_column.download_button(
+            label=f"Download Report as {export_format}",
+            data=data,
+            file_name=f"{domain_view.domain}{suffix}_report."
+            f"{EXPORT_FORMATS[export_format]['extension']}",
+            mime=EXPORT_FORMATS[export_format]["mime"],
+        )
+
+
+def rerun():
+    """Reruns the whole script."""
+    # st.rerun replaced st.experimental_rerun in later Streamlit versions
+    (getattr(st, "rerun", None) or st.experimental_rerun)()
+
+
+def show_regeneration_progress(regenerator):
+    """Shows the progress of the running regeneration, and reruns the whole script to
+    serve its result once it ended."""
+    progress = regenerator.progress
+    if progress is not None:
+        st.progress(progress.get_fraction())
+        st.caption(
+            f"Regenerating since {progress.started_at:%H:%M:%S}: {progress.description}"
+        )
+    if not regenerator.is_running():
+        rerun()
+
+
+def follow_regeneration(regenerator, container):
+    """Refreshes the progress of the running regeneration in a container until it ends.
+
+    With st.fragment, only the progress is rerun every REGENERATION_POLL_SECONDS, and
+    the script thread is not held. Streamlit versions without fragments rerun the
+    whole script instead.
+    """
+    fragment = getattr(st, "fragment", None) or getattr(
+        st, "experimental_fragment", None
+    )
+    with container:
+        if fragment is not None:
+            fragment(run_every=REGENERATION_POLL_SECONDS)(show_regeneration_progress)(
+                regenerator
             )
-    if len(filter_conditions) > 0:
-        filtered_dataframe = dataframe[filter_conditions[0]]
-        for condition in filter_conditions[1:]:
-            filtered_dataframe = filtered_dataframe[condition]
-    else:
-        filtered_dataframe = dataframe.copy()
+            return
+        show_regeneration_progress(regenerator)
+    time.sleep(REGENERATION_POLL_SECONDS)
+    rerun()
+
 
-    return filtered_dataframe
+def regenerate_dataframe_on_button_press(regenerator, data_as_of, data_version):
+    """Starts a background regeneration when the button is pressed, and shows the age
+    of the served data.
 
+    The served data stays in use until the regeneration completes. Pressing the
+    button while a regeneration is running joins it.
 
-def regenerate_dataframe_on_button_press(dataframe):
-    """Regenerates the dataframe when the button is pressed."""
+    Returns:
+        The sidebar container the progress of a running regeneration is shown in.
+    """
+    incremental = st.sidebar.checkbox(
+        "Incremental refresh",
+        value=True,
+        help="Only fetch the current date range and update the affected rows.",
+    )
     if st.sidebar.button("Regenerate DataFrame"):
-        dataframe = generate_dataframe()
-        domains = dataframe["Domain"].unique()
+        if not regenerator.request(incremental=incremental):
+            st.sidebar.info("A regeneration is already running")
+
+    progress_container = st.sidebar.container()
+    if not regenerator.is_running() and regenerator.error is not None:
+        st.sidebar.error(f"Regeneration failed: {regenerator.error}")
+
+    # Tell the session when the data it was looking at was swapped
+    seen_version = st.session_state.get("data_version")
+    if seen_version is not None and seen_version != data_version:
         st.sidebar.success("DataFrame regenerated")
+    st.session_state.data_version = data_version
+
+    if data_as_of is not None:
+        st.sidebar.caption(f"Data as of {data_as_of:%Y-%m-%d %H:%M}")
+    return progress_container
+
+
+def show_profiling_panel(rerun_seconds):
+    """Shows the latency of this rerun and the report of the last profiled run."""
+    with st.sidebar.expander("Profiling"):
+        st.metric("Rerun latency", f"{rerun_seconds * 1000:.0f} ms")
 
-    return dataframe
+        report = load_run_report()
+        if report is None:
+            st.caption("No profiled run yet")
+            return
+        st.caption(
+            f"Last run: {report['run']} started at {report['started_at']}, "
+            f"{report['wall_seconds']:.1f} s wall, {report['cpu_seconds']:.1f} s CPU, "
+            f"{report['peak_memory_bytes'] / 1024**2:.1f} MB peak"
+        )
+        stages_df = pd.DataFrame(report["stages"])
+        if not stages_df.empty:
+            stages_df["name"] = [
+                "  " * depth + name
+                for name, depth in zip(stages_df["name"], stages_df["depth"])
+            ]
+            stages_df["peak_memory_mb"] = (
+                stages_df["peak_memory_bytes"] / 1024**2
+            ).round(1)
+            st.dataframe(
+                stages_df.set_index("name")[
+                    [
+                        "wall_seconds",
+                        "cpu_seconds",
+                        "peak_memory_mb",
+                        "rows_in",
+                        "rows_out",
+                    ]
+                ]
+            )
 
 
 # log in logic to google
 st.set_page_config(layout="wide")
 pd.set_option("display.max_rows", 1000)
 
-# Generate the dataframe
-df = generate_dataframe()
+# Serve the current dataframe. The whole rerun uses this snapshot, even if a
+# background regeneration swaps in a new one meanwhile
+regenerator = get_regenerator()
+domain_index, data_as_of, data_version = regenerator.get_snapshot()
 # gen mpty dataframe
 filtered_dataframe = pd.DataFrame()
 
 # Regenerate the dataframe on button press
-df = regenerate_dataframe_on_button_press(df)
+progress_container = regenerate_dataframe_on_button_press(
+    regenerator, data_as_of, data_version
+)
 
-# Get domain names for select box
-domains = df["Domain"].unique()
+# Get domain names for select box, already sorted by the index
+domains = domain_index.domains if domain_index is not None else []
 
 # Display a select box of domain options
 if len(domains) > 0:
-    selected_domain = st.sidebar.selectbox("Select a domain", sorted(domains))
+    selected_domain = st.sidebar.selectbox("Select a domain", domains)
 else:
     selected_domain = None
 
 # Filter the dataframe by the selected domain and display it
-if df is not None and selected_domain is not None:
+if selected_domain is not None:
     # Set header text
     st.header(f"{selected_domain.capitalize()} Data")
 
-    # Only generate filtered dataframe if it doesn't already exist
-    if "filtered_dataframe" not in st.session_state:
-        st.session_state.filtered_dataframe = pd.DataFrame()
-    if (
-        not st.session_state.filtered_dataframe.empty
-        and st.session_state.filtered_dataframe["Domain"].iloc[0] == selected_domain
-    ):
-        filtered_dataframe = st.session_state.filtered_dataframe
+    # Rows of the selected domain, a slice of the indexed dataframe
+    domain_view = domain_index.get_view(selected_domain)
+
+    ranges = select_ranges_with_sliders(domain_view, *DASHBOARD_FILTER_COLUMNS)
+    # Display filtered dataframe, one page at a time unless the whole table is asked for
+    if st.sidebar.checkbox("Paginated table", value=True):
+        show_paginated_table(domain_view, domain_view.get_positions(ranges))
     else:
-        filtered_dataframe = df[df["Domain"] == selected_domain]
-        st.session_state.filtered_dataframe = filtered_dataframe
+        filtered_dataframe = domain_view.filter_ranges(ranges)
+        st.write(filtered_dataframe)
 
-    filtered_dataframe = filter_dataframe_with_sliders(
-        filtered_dataframe, "Adjusted Clicks", "Impressions"
-    )
-    # Display filtered dataframe
-    st.write(filtered_dataframe)
-
-    # Add a button to download the filtered dataframe as a CSV file
-    # csv_data = convert_dataframe_to_csv(filtered_dataframe)
-    # st.download_button(
-    #     label="Download Report as CSV",
-    #     data=csv_data,
-    #     file_name=f"{selected_domain}_report.csv",
-    #     mime="text/csv",
-    # )
+    # Add buttons to download the filtered rows or the whole domain
+    show_export_buttons(domain_view, ranges, data_version)
 
+elif domain_index is None and regenerator.is_running():
+    st.info("The DataFrame is being generated, it will show up here when it is ready")
 else:
     st.warning("Please generate the DataFrame and select a domain")
+
+if PROFILING_ENABLED:
+    show_profiling_panel(time.perf_counter() - RERUN_STARTED)
+
+# Follow a running regeneration, and pick up its result once it ended
+if regenerator.is_running():
+    follow_regeneration(regenerator, progress_container)
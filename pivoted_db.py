@@ -1,10 +1,47 @@
+import hashlib
+import os
+import pickle
+import re
+import warnings
+from contextlib import nullcontext
+from pathlib import Path
 import pandas as pd
 import numpy as np
-from utils import download_gsheet
+from utils import register_gsheet
+from utils import fetch_gsheet
+from utils import download_gsheets
+from utils import get_date_ranges
+from utils import get_date_range_labels
+from utils import compact_dtypes
+from utils import align_categories
 from gsc import get_gsc_data_df
+from gsc import GSC_FETCH_MODE
+from gsc import has_daily_facts
 from click_tracking import get_click_data_df
+from storage import write_dataset
+from dag import Dag
+from profiling import profiled
+from profiling import profiled_run
 from stqdm import stqdm
 
+# Location of the last computed result, used by the incremental regenerate
+LAST_RESULT_PATH = "cache/last_result.pkl"
+# Columns identifying a keyword row before and after the pretty rename
+KEY_COLUMNS = ["query", "page", "country"]
+PRETTY_KEY_COLUMNS = ["Keyword", "Page", "Country"]
+# Progress steps of gen_db_df before the DAG: the sheets, GSC, the clicks and filter rules
+GEN_DB_LOAD_STEPS = 3
+# Progress steps of gen_db_df_incremental: the sheets, GSC, the splice and the recompute
+GEN_DB_INCREMENTAL_STEPS = 4
+# Compiled filter rules, keyed by a hash of the filter rules sheet contents
+_COMPILED_FILTER_RULES = {}
+# Sheet of the keyword filter rules
+FILTER_RULES_GSHEET = register_gsheet(
+    "filter_rules",
+    "https://docs.google.com/spreadsheets/d/1uBsysJd1XTtOftpD04W_vlWDRXczzeESmbS51DP0U_0/edit#gid=0",
+    "gsheet/filter_rules.csv",
+)
+
 
 # This function takes a row from the db_df DataFrame and the entire filter_df DataFrame as input arguments. It checks whether the row from db_df matches any of the filtering rules in filter_df. If a match is found, it returns True or False based on the filter type. If no match is found, the function returns False, meaning the row should not be kept.
 def apply_filter(row, filter_df):
@@ -29,6 +66,119 @@ def apply_filter(row, filter_df):
     return False
 
 
+def compile_filter_program(filter_df):
+    """
+    Compiles an ordered list of filter rules into a list of (pattern, keep) steps.
+
+    Consecutive rules with the same filter type are combined into one regex pattern
+    that matches any of their keywords as a plain substring. Evaluating the steps in
+    order and stopping at the first step that matches gives the same result as
+    checking the rules one by one in sheet order.
+    """
+    program = []
+    for _, keywords in filter_df.groupby(
+        (filter_df["Filter Type"] != filter_df["Filter Type"].shift()).cumsum(),
+        sort=True,
+    ):
+        keep = keywords["Filter Type"].iloc[0] == "Whitelist"
+        pattern = "|".join(re.escape(str(keyword)) for keyword in keywords["Keyword"])
+        program.append((pattern, keep))
+    return program
+
+
+def compile_filter_rules(filter_df):
+    """
+    Compiles the filter rules into one matcher program per domain.
+
+    Every domain with its own rules gets a program of its rules and the "All" rules in
+    sheet order. Rows of the other domains use the program of the "All" rules. Rules
+    without a domain never match, as NaN never equals a row's domain.
+
+    Args:
+        filter_df (pd.DataFrame): The filter rules with "Keyword", "Domain" and "Filter Type" columns.
+
+    Returns:
+        dict: The "domains" programs keyed by domain and the "All" program.
+    """
+    filter_df = filter_df[
+        filter_df["Keyword"].notna()
+        & filter_df["Filter Type"].isin(["Blacklist", "Whitelist"])
+    ]
+    is_all = filter_df["Domain"] == "All"
+
+    domain_programs = {}
+    for domain in filter_df.loc[~is_all, "Domain"].dropna().unique():
+        domain_programs[domain] = compile_filter_program(
+            filter_df[is_all | (filter_df["Domain"] == domain)]
+        )
+
+    return {
+        "domains": domain_programs,
+        "All": compile_filter_program(filter_df[is_all]),
+    }
+
+
+def get_filter_rules_key(filter_df):
+    """
+    Returns a hash of the filter rules sheet contents.
+    """
+    return hashlib.sha256(filter_df.to_csv(index=False).encode("utf-8")).hexdigest()
+
+
+def get_compiled_filter_rules(filter_df):
+    """
+    Returns the compiled filter rules, compiling them only when the sheet contents change.
+    """
+    key = get_filter_rules_key(filter_df)
+    if key not in _COMPILED_FILTER_RULES:
+        _COMPILED_FILTER_RULES.clear()
+        _COMPILED_FILTER_RULES[key] = compile_filter_rules(filter_df)
+    return _COMPILED_FILTER_RULES[key]
+
+
+def get_filter_mask(df, filter_df):
+    """
+    Returns a boolean mask of the rows kept by the filter rules.
+
+    Gives the same result as applying `apply_filter` to every row: the first matching
+    rule decides, Whitelist keeps the row, and rows without a matching rule are dropped.
+
+    Args:
+        df (pd.DataFrame): The DataFrame with "Keyword" and "Domain" columns.
+        filter_df (pd.DataFrame): The filter rules.
+
+    Returns:
+        pd.Series: True for every row to keep.
+    """
+    compiled_rules = get_compiled_filter_rules(filter_df)
+    domain_programs = compiled_rules["domains"]
+
+    keywords = df["Keyword"].fillna("")
+    domains = df["Domain"]
+    keep = np.zeros(len(df), dtype=bool)
+
+    programs = [
+        (domains == domain, program) for domain, program in domain_programs.items()
+    ]
+    programs.append((~domains.isin(list(domain_programs)), compiled_rules["All"]))
+
+    for rows, program in programs:
+        undecided = np.flatnonzero(rows.to_numpy())
+        for pattern, keep_value in program:
+            if len(undecided) == 0:
+                break
+            # Match the undecided keywords column-wise, in Arrow for Arrow strings
+            matched = (
+                keywords.iloc[undecided]
+                .str.contains(pattern, regex=True)
+                .to_numpy(dtype=bool)
+            )
+            keep[undecided[matched]] = keep_value
+            undecided = undecided[~matched]
+
+    return pd.Series(keep, index=df.index)
+
+
 # create a function that merges gsc_df and click_data_df on query,page,country,start_date, end_date, domain
 def merge_gsc_and_click_data(gsc_df, click_data_df) -> pd.DataFrame:
     """
@@ -43,6 +193,7 @@ def merge_gsc_and_click_data(gsc_df, click_data_df) -> pd.DataFrame:
 
     """
 
+    gsc_df, click_data_df = align_categories(gsc_df, click_data_df)
     merged_df = pd.merge(
         gsc_df,
         click_data_df,
@@ -50,16 +201,29 @@ def merge_gsc_and_click_data(gsc_df, click_data_df) -> pd.DataFrame:
         on=["query", "page", "country", "date_range", "domain"],
     )
 
-    return merged_df
+    return compact_dtypes(merged_df, stage="merge")
 
 
-def aggregate_clicks_impressions_by_query_page_country(df):
+def aggregate_clicks_impressions_by_query_page_country(df, date_range_labels=None):
     # Pivot the dataframe to aggregate clicks and impressions by query, page, country, and date range.
     click_impressions_by_query_page_country = df.pivot(
         index=["query", "page", "country"],
         columns="date_range",
         values=["position"],
-    ).reset_index()
+    )
+
+    # Keep a column for every date range, even when a subset of rows has no data for it
+    if date_range_labels is not None:
+        click_impressions_by_query_page_country = (
+            click_impressions_by_query_page_country.reindex(
+                columns=pd.MultiIndex.from_product(
+                    [["position"], sorted(date_range_labels)]
+                )
+            )
+        )
+    click_impressions_by_query_page_country = (
+        click_impressions_by_query_page_country.reset_index()
+    )
 
     # Rename the columns to include the metric (clicks or impressions) and the date range.
     click_impressions_by_query_page_country.columns = [
@@ -76,33 +240,34 @@ def aggregate_clicks_impressions_by_query_page_country(df):
 
 
 def get_adjusted_clicks(df):
-    # create a column "adjusted_clicks" which is the difference between "clicks","in_house_clicks",	"serpclix_clicks". If the value is NaN, treat it as 0.
-    df["adjusted_clicks"] = df.apply(
-        lambda row: row["clicks"] - row["in_house_clicks"] - row["serpclix_clicks"]
-        if not pd.isnull(row["in_house_clicks"])
-        and not pd.isnull(row["serpclix_clicks"])
-        else row["clicks"],
-        axis=1,
+    # create a column "adjusted_clicks" which is the difference between "clicks","in_house_clicks",	"serpclix_clicks".
+    # If either click tracking value is NaN, keep the GSC clicks.
+    has_click_tracking = df["in_house_clicks"].notna() & df["serpclix_clicks"].notna()
+    return df.assign(
+        adjusted_clicks=(
+            df["clicks"] - df["in_house_clicks"] - df["serpclix_clicks"]
+        ).where(has_click_tracking, df["clicks"])
     )
-    return df
 
 
 def fill_na_with_zero(df):
     # fill the NaN with 0 for the collumns "clicks","in_house_clicks",	"serpclix_clicks"
-    df[["clicks", "in_house_clicks", "serpclix_clicks", "impressions"]] = df[
-        ["clicks", "in_house_clicks", "serpclix_clicks", "impressions"]
-    ].fillna(0)
-    return df
+    count_columns = ["clicks", "in_house_clicks", "serpclix_clicks", "impressions"]
+    df = df.fillna({column: 0 for column in count_columns})
+    # The counts can't be missing anymore, store them as int32
+    return compact_dtypes(df)
 
 
 def remove_root_domain_rows(df):
     # remove the rows with the root domain
     # if page contains less or equal than 3 "/", remove the row
-    df = df[df["page"].str.count("/") > 3]
+    df = df[(df["page"].str.count("/") > 3).fillna(False)]
     return df
 
 
-def create_first_rank_column(df):
+def create_first_rank_column(df, date_range_labels=None):
+    # date_range_labels is given when df may be a subset of the keywords, see
+    # build_final_df, e.g. only keywords whose clicks changed, which may have no rank
     # Check if all required columns are present in df
     required_cols = [
         "current_rank",
@@ -115,18 +280,11 @@ def create_first_rank_column(df):
     if not set(required_cols).issubset(df.columns):
         raise ValueError("Input dataframe is missing one or more required columns")
 
-    # Define a function to extract the first non-NaN value from a list of values
-    def get_first_rank(row):
-        for col in required_cols:
-            if not pd.isnull(row[col]):
-                return row[col]
-        return np.nan
-
-    # Create the "first_rank" column
-    df["first_rank"] = df.apply(get_first_rank, axis=1)
+    # Create the "first_rank" column from the first non-NaN rank, from current to oldest
+    df = df.assign(first_rank=df[required_cols].bfill(axis=1).iloc[:, 0])
 
     # Handle cases where "first_rank" column contains only NaN values
-    if df["first_rank"].isnull().all():
+    if date_range_labels is None and df["first_rank"].isnull().all():
         raise ValueError("All previous rank columns contain NaN values")
 
     return df
@@ -199,7 +357,7 @@ def rename_columns(df):
         "page",
         "country",
     ]
-    df.columns = new_column_names + list(df.columns[9:])
+    df = df.set_axis(new_column_names + list(df.columns[9:]), axis=1)
 
     return df
 
@@ -243,10 +401,17 @@ def add_average_rank(df):
         "previous_rank_4",
         "previous_rank_5",
     ]
-    df["average_rank"] = (
-        df[rank_cols].apply(lambda x: np.nanmean(x), axis=1).round(decimals=1)
+    # Ranks are float32, round them back to their single decimal once widened to float64
+    ranks = df[rank_cols].to_numpy(dtype=float).round(decimals=1)
+    # Rows without any rank have a NaN average, silence the "Mean of empty slice" warning
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        average_rank = np.nanmean(ranks, axis=1)
+    return df.assign(
+        average_rank=pd.Series(average_rank, index=df.index)
+        .round(decimals=1)
+        .astype("float32")
     )
-    return df
 
 
 def pretty_rename(df):
@@ -274,96 +439,357 @@ def pretty_rename(df):
     return df
 
 
-def gen_db_df():
-    gsc_df = get_gsc_data_df()
-    click_data_df = get_click_data_df()
+@profiled("load_filter_rules")
+def load_filter_rules():
+    """Downloads the filter rules sheet and returns it as a DataFrame."""
+    return pd.read_csv(fetch_gsheet(FILTER_RULES_GSHEET), sep=",", encoding="utf-8")
 
-    # Add a stqdm for the number of steps
-    with stqdm(total=13) as pbar:
-        pbar.set_description("Processing data")
 
-        # Step 1: Merge GSC and Click Data
-        pbar.set_description("Step 1: Merging GSC and Click Data")
-        merged_df = merge_gsc_and_click_data(gsc_df, click_data_df)
-        pbar.update(1)
+def prepare_merged_df(merged_df):
+    """Runs the row-level cleaning steps on merged GSC and click data."""
+    merged_df = remove_root_domain_rows(merged_df)
+    merged_df = fill_na_with_zero(merged_df)
+    merged_df = get_adjusted_clicks(merged_df)
+    return merged_df
+
+
+def pivot_ranks(merged_df, date_range_labels=None):
+    """Pivots the positions of every date range into one row per query, page and country."""
+    pivoted_df = aggregate_clicks_impressions_by_query_page_country(
+        merged_df, date_range_labels
+    )
+    return compact_dtypes(pivoted_df, stage="pivot")
+
+
+def combine_ranks(merged_df, pivoted_df):
+    """Joins the pivoted ranks back onto the rows of the first ranked date range."""
+    final_df = combine_merged_df_with_pivoted(merged_df, pivoted_df)
+    return drop_columns(final_df, ["first_rank", "position", "source"])
+
+
+def rename_final_columns(df):
+    """Gives the final columns their readable names."""
+    return compact_dtypes(pretty_rename(df), stage="final")
+
+
+def filter_final_df(final_df, filter_rules_df):
+    """Keeps the rows allowed by the filter rules."""
+    return final_df[get_filter_mask(final_df, filter_rules_df)]
 
-        # Step 2: Remove root domain rows
-        pbar.set_description("Step 2: Removing root domain rows")
-        merged_df = remove_root_domain_rows(merged_df)
-        pbar.update(1)
 
-        # Step 3: Download domain list from Google Sheet
-        pbar.set_description("Step 3: Download domain list from Google Sheet")
-        filter_rules = "https://docs.google.com/spreadsheets/d/1uBsysJd1XTtOftpD04W_vlWDRXczzeESmbS51DP0U_0/edit#gid=0"
-        download_gsheet(filter_rules, "gsheet/filter_rules.csv")
-        filter_rules_df = pd.read_csv(
-            "gsheet/filter_rules.csv", sep=",", encoding="utf-8"
+# Steps of gen_db_df. Sources: "gsc", "click_data", "filter_rules" and "date_range_labels"
+GEN_DB_DAG = (
+    Dag()
+    .add(
+        "merge",
+        merge_gsc_and_click_data,
+        ["gsc", "click_data"],
+        "Merging GSC and Click Data",
+    )
+    .add(
+        "remove_root_domain_rows",
+        remove_root_domain_rows,
+        ["merge"],
+        "Removing root domain rows",
+    )
+    .add(
+        "fill_na_with_zero",
+        fill_na_with_zero,
+        ["remove_root_domain_rows"],
+        "Filling missing values with 0",
+    )
+    .add(
+        "adjusted_clicks",
+        get_adjusted_clicks,
+        ["fill_na_with_zero"],
+        "Getting adjusted clicks for each row",
+    )
+    .add(
+        "pivot",
+        pivot_ranks,
+        ["adjusted_clicks", "date_range_labels"],
+        "Aggregating positions by query, page and country",
+    )
+    .add("rename_pivot", rename_columns, ["pivot"], "Renaming columns")
+    .add(
+        "first_rank",
+        create_first_rank_column,
+        ["rename_pivot", "date_range_labels"],
+        "Creating first_rank column",
+    )
+    .add(
+        "combine",
+        combine_ranks,
+        ["adjusted_clicks", "first_rank"],
+        "Combining merged_df with pivoted_df",
+    )
+    .add("average_rank", add_average_rank, ["combine"], "Adding average rank")
+    .add("reorder", reorder_dataframe, ["average_rank"], "Reordering columns")
+    .add(
+        "pretty_rename",
+        rename_final_columns,
+        ["reorder"],
+        "Renaming columns to be more readable",
+    )
+    .add(
+        "filter",
+        filter_final_df,
+        ["pretty_rename", "filter_rules"],
+        "Applying filter rules",
+    )
+)
+# Parquet dataset written with the output of each node when it is computed. The
+# "final" dataset served by the dashboard is written by every run instead.
+SNAPSHOT_DATASETS = {
+    "combine": "combined",
+    "pretty_rename": "final_unfiltered",
+}
+
+
+def write_snapshot(name, df):
+    """Writes the output of a GEN_DB_DAG node to its Parquet dataset, if it has one."""
+    if name in SNAPSHOT_DATASETS:
+        write_dataset(df, SNAPSHOT_DATASETS[name])
+
+
+def build_final_df(
+    merged_df, filter_rules_df, date_range_labels=None, pbar=None, save_snapshots=True
+):
+    """
+    Pivots the merged data into one row per keyword, page and country and applies the filter rules.
+
+    Runs the GEN_DB_DAG steps after "adjusted_clicks", without memoization. Every step
+    only looks at the rows of a single query, page and country, so it can also be run
+    on a subset of keywords.
+
+    Args:
+        merged_df (pd.DataFrame): The merged and cleaned GSC and click data.
+        filter_rules_df (pd.DataFrame): The filter rules.
+        date_range_labels (list, optional): Every date range label expected in the pivot,
+            given when merged_df may be a subset of the keywords.
+        pbar (stqdm, optional): The progress bar updated after every step.
+        save_snapshots (bool): Whether to write the intermediate Parquet datasets.
+
+    Returns:
+        tuple: The final DataFrame before and after the filter rules.
+    """
+    outputs = GEN_DB_DAG.run(
+        {
+            "adjusted_clicks": merged_df,
+            "filter_rules": filter_rules_df,
+            "date_range_labels": date_range_labels,
+        },
+        ["pretty_rename", "filter"],
+        memoize=False,
+        pbar=pbar,
+        on_computed=write_snapshot if save_snapshots else None,
+    )
+    return outputs["pretty_rename"], outputs["filter"]
+
+
+def replace_keyword_rows(final_df, new_final_df, keys):
+    """Replaces the rows of some keywords of a final DataFrame with their new rows."""
+    is_stale = pd.MultiIndex.from_frame(final_df[PRETTY_KEY_COLUMNS]).isin(keys)
+    final_df, new_final_df = align_categories(final_df, new_final_df)
+    return pd.concat([final_df[~is_stale], new_final_df], ignore_index=True)
+
+
+@profiled("save_last_result")
+def save_last_result(
+    date_range_labels,
+    filter_rules_key,
+    merged_df,
+    unfiltered_df,
+    final_df,
+    path=LAST_RESULT_PATH,
+):
+    """Saves the merged data and the final DataFrame, before and after the filter rules,
+    for the incremental regenerate.
+
+    The file is replaced atomically, so a failed run never leaves it half written.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as file:
+        pickle.dump(
+            {
+                "date_range_labels": date_range_labels,
+                "filter_rules_key": filter_rules_key,
+                "merged_df": merged_df,
+                "unfiltered_df": unfiltered_df,
+                "final_df": final_df,
+            },
+            file,
+            protocol=pickle.HIGHEST_PROTOCOL,
         )
-        pbar.update(1)
+    os.replace(tmp_path, path)
+
 
-        # Step 4: Apply filter rules to merged_df
-        pbar.set_description("Step 4: Applying filter rules to merged data")
-        # merged_df = merged_df[
-        #     merged_df.apply(lambda row: apply_filter(row, filter_rules_df), axis=1)
-        # ]
+def load_last_result(path=LAST_RESULT_PATH):
+    """Loads the last saved result, or None if there is none."""
+    if not Path(path).is_file():
+        return None
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+@profiled_run("gen_db_df")
+def gen_db_df(gsc_mode=GSC_FETCH_MODE, incremental_gsc=False, pbar=None):
+    """
+    Builds the final DataFrame from GSC, the click tracking sheets and the filter rules.
+
+    The steps run as GEN_DB_DAG nodes memoized on disk, so only the steps downstream of
+    a changed input are recomputed: when only the filter rules changed, only the
+    filtering step runs again.
+
+    Args:
+        gsc_mode (str): How the GSC data is fetched, see get_gsc_data_df.
+        incremental_gsc (bool): Only fetch the GSC days missing from the fact store.
+        pbar (stqdm, optional): The progress bar of the run, a new stqdm by default.
+            It is reset to one step per input loaded and one per DAG node.
+
+    Returns:
+        pd.DataFrame: The final filtered DataFrame.
+    """
+    total = GEN_DB_LOAD_STEPS + len(GEN_DB_DAG.nodes)
+    with stqdm(total=total) if pbar is None else nullcontext(pbar) as pbar:
+        pbar.reset(total=total)
+
+        # Download every sheet of the run at once
+        pbar.set_description("Downloading sheets")
+        download_gsheets()
         pbar.update(1)
-        # Step 5: Fill missing values with 0
-        pbar.set_description("Step 5: Filling missing values with 0")
-        merged_df = fill_na_with_zero(merged_df)
+
+        pbar.set_description("Fetching Search Console data")
+        gsc_df = get_gsc_data_df(mode=gsc_mode, incremental=incremental_gsc)
         pbar.update(1)
 
-        # Step 6: Get adjusted clicks for each row
-        pbar.set_description("Step 6: Getting adjusted clicks for each row")
-        merged_df = get_adjusted_clicks(merged_df)
+        pbar.set_description("Loading click data and filter rules")
+        click_data_df = get_click_data_df()
+        filter_rules_df = load_filter_rules()
+        date_range_labels = get_date_range_labels(get_date_ranges())
         pbar.update(1)
 
-        # Step 7: Aggregate clicks and impressions by query, page and country
-        pbar.set_description(
-            "Step 7: Aggregating clicks and impressions by query, page and country"
+        outputs = GEN_DB_DAG.run(
+            {
+                "gsc": gsc_df,
+                "click_data": click_data_df,
+                "filter_rules": filter_rules_df,
+                "date_range_labels": None,
+            },
+            ["adjusted_clicks", "pretty_rename", "filter"],
+            pbar=pbar,
+            on_computed=write_snapshot,
         )
-        pivoted_df = aggregate_clicks_impressions_by_query_page_country(merged_df)
-        pbar.update(1)
+    merged_df = outputs["adjusted_clicks"]
+    final_df = outputs["filter"]
+
+    # Even when loaded from the DAG cache, an incremental run may have replaced it since
+    write_dataset(final_df, "final")
+    save_last_result(
+        date_range_labels,
+        get_filter_rules_key(filter_rules_df),
+        merged_df,
+        outputs["pretty_rename"],
+        final_df,
+    )
 
-        # Step 8: Rename columns in pivoted_df
-        pbar.set_description("Step 8: Renaming columns")
-        pivoted_df = rename_columns(pivoted_df)
-        pbar.update(1)
+    return final_df
 
-        # Step 9: Create first_rank column in pivoted_df
-        pbar.set_description("Step 9: Creating first_rank column")
-        pivoted_df = create_first_rank_column(pivoted_df)
-        pbar.update(1)
 
-        # Step 10: Combine merged_df with pivoted_df
-        pbar.set_description("Step 10: Combining merged_df with pivoted_df")
-        final_df = combine_merged_df_with_pivoted(merged_df, pivoted_df)
-        final_df = drop_columns(final_df, ["first_rank", "position", "source"])
-        pbar.update(1)
-        final_df.to_csv("test/final_10_df.csv", index=False)
+@profiled_run("gen_db_df_incremental")
+def gen_db_df_incremental(pbar=None):
+    """
+    Refreshes the last result by fetching only the current date range.
 
-        # Step 11: Reorder columns in final_df
-        pbar.set_description("Step 11: Reordering columns")
-        final_df = add_average_rank(final_df)
-        pbar.update(1)
+    The current date range is fetched from GSC and spliced into the saved merged data,
+    and only the keywords whose rows changed are pivoted and ranked again. When the
+    filter rules changed, they are applied again to every keyword. When the
+    month has rolled over, every date range shifts, so the date ranges are rebuilt
+    from the daily fact store, which only fetches the days it is missing. Without
+    stored daily facts, that would fetch every day of every date range, so the
+    result is rebuilt from scratch instead.
 
-        # Step 12: Reorder columns in final_df
-        pbar.set_description("Step 12: Reordering columns")
-        final_df = reorder_dataframe(final_df)
-        pbar.update(1)
+    Args:
+        pbar (stqdm, optional): The progress bar of the run, a new stqdm by default.
 
-        # Step 13: Rename columns in final_df
-        pbar.set_description("Step 13: Renaming columns to be more readable")
-        final_df = pretty_rename(final_df)
-        final_df.to_csv("gsheet/final_12_df.csv", index=False)
+    Returns:
+        pd.DataFrame: The final filtered DataFrame.
+    """
+    last_result = load_last_result()
+    date_range_labels = get_date_range_labels(get_date_ranges())
+
+    # Results saved before the unfiltered table was kept are rebuilt once
+    if last_result is None or "unfiltered_df" not in last_result:
+        return gen_db_df(pbar=pbar)
+    if last_result["date_range_labels"] != date_range_labels:
+        if not has_daily_facts():
+            return gen_db_df(pbar=pbar)
+        return gen_db_df(gsc_mode="daily", incremental_gsc=True, pbar=pbar)
+
+    total = GEN_DB_INCREMENTAL_STEPS
+    with stqdm(total=total) if pbar is None else nullcontext(pbar) as pbar:
+        pbar.reset(total=total)
+
+        # Download every sheet of the run at once
+        pbar.set_description("Downloading sheets")
+        download_gsheets()
+        pbar.update(1)
 
-        final_df = final_df[
-            final_df.apply(lambda row: apply_filter(row, filter_rules_df), axis=1)
-        ]
+        pbar.set_description("Fetching the current date range from Search Console")
+        gsc_df = get_gsc_data_df(window_indices=[0])
+        if gsc_df is None:
+            return gen_db_df(pbar=pbar)
+        pbar.update(1)
 
-        final_df.to_csv("gsheet/final_13_df.csv", index=False)
+        # Rebuild the merged rows of the current date range
+        pbar.set_description("Updating the current date range")
+        current_label = date_range_labels[0]
+        click_data_df = get_click_data_df()
+        click_data_df = click_data_df[click_data_df["date_range"] == current_label]
+        current_df = prepare_merged_df(merge_gsc_and_click_data(gsc_df, click_data_df))
+
+        # Splice them into the saved merged data
+        merged_df, current_df = align_categories(last_result["merged_df"], current_df)
+        is_current = merged_df["date_range"] == current_label
+        affected_keys = pd.MultiIndex.from_frame(
+            pd.concat([merged_df.loc[is_current, KEY_COLUMNS], current_df[KEY_COLUMNS]])
+        ).unique()
+        merged_df = pd.concat([merged_df[~is_current], current_df], ignore_index=True)
+        pbar.update(1)
 
+        # Recompute the final rows of the affected keywords only
+        pbar.set_description("Recomputing the affected keywords")
+        filter_rules_df = load_filter_rules()
+        filter_rules_key = get_filter_rules_key(filter_rules_df)
+        unfiltered_df = last_result["unfiltered_df"]
+        final_df = last_result["final_df"]
+        is_affected = pd.MultiIndex.from_frame(merged_df[KEY_COLUMNS]).isin(
+            affected_keys
+        )
+        if is_affected.any():
+            affected_unfiltered_df, affected_final_df = build_final_df(
+                merged_df[is_affected],
+                filter_rules_df,
+                date_range_labels=date_range_labels,
+                save_snapshots=False,
+            )
+            unfiltered_df = replace_keyword_rows(
+                unfiltered_df, affected_unfiltered_df, affected_keys
+            )
+            final_df = replace_keyword_rows(final_df, affected_final_df, affected_keys)
+        # New rules may keep or drop any keyword, not only the affected ones
+        if filter_rules_key != last_result["filter_rules_key"]:
+            final_df = filter_final_df(unfiltered_df, filter_rules_df)
+        if is_affected.any() or filter_rules_key != last_result["filter_rules_key"]:
+            write_dataset(final_df, "final")
         pbar.update(1)
 
+    save_last_result(
+        date_range_labels, filter_rules_key, merged_df, unfiltered_df, final_df
+    )
+
     return final_df
 
 
@@ -0,0 +1,250 @@
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+# Set PIPELINE_PROFILING=1 to record a report of every run. Off, profiling costs nothing
+PROFILING_ENABLED = os.environ.get("PIPELINE_PROFILING", "0") == "1"
+# Location of the JSON report of the last run
+PROFILE_REPORT_PATH = os.environ.get("PROFILE_REPORT_PATH", "reports/run_report.json")
+
+# Run being profiled, shared by every thread, and the stages open in each thread
+_RUN = None
+_RUN_LOCK = threading.Lock()
+_LOCAL = threading.local()
+
+
+class StageProfile:
+    """
+    Measurements of one stage: wall time, CPU time, peak traced memory and row counts.
+    """
+
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.rows_in = None
+        self.rows_out = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_memory_bytes = None
+        self.offset_seconds = None
+        # Highest traced memory seen while the stage was open, for the nested stages
+        self.max_traced_bytes = 0
+
+    def set_rows(self, inputs=None, output=None):
+        """
+        Records the number of input and output rows, counted from DataFrames.
+        """
+        if inputs is not None:
+            self.rows_in = count_rows(inputs)
+        if output is not None:
+            self.rows_out = count_rows(output)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "depth": self.depth,
+            "offset_seconds": self.offset_seconds,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+        }
+
+
+class _NoopStage:
+    """
+    Stands in for a StageProfile when profiling is off or no run is being profiled.
+    """
+
+    def set_rows(self, inputs=None, output=None):
+        pass
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+def count_rows(value):
+    """
+    Returns the number of rows of a DataFrame, or of the DataFrames in a list, tuple
+    or dict. None if there is no DataFrame.
+    """
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _get_stack():
+    if not hasattr(_LOCAL, "stack"):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+@contextmanager
+def profile_stage(name):
+    """
+    Measures a block of code as a stage of the run being profiled.
+
+    Yields a StageProfile, whose set_rows records the row counts of the stage. Stages
+    can be nested; the peak memory of a stage is the highest traced memory while it
+    ran, above the memory traced when it started.
+    """
+    if not PROFILING_ENABLED or _RUN is None:
+        yield _NOOP_STAGE
+        return
+
+    stack = _get_stack()
+    stage = StageProfile(name, depth=len(stack))
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1].max_traced_bytes = max(stack[-1].max_traced_bytes, peak_bytes)
+    tracemalloc.reset_peak()
+    stage.max_traced_bytes = current_bytes
+    stack.append(stage)
+
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    stage.offset_seconds = round(wall_started - _RUN["perf_started"], 6)
+    try:
+        yield stage
+    finally:
+        stage.wall_seconds = round(time.perf_counter() - wall_started, 6)
+        stage.cpu_seconds = round(time.process_time() - cpu_started, 6)
+        stack.pop()
+
+        peak_bytes = max(stage.max_traced_bytes, tracemalloc.get_traced_memory()[1])
+        stage.peak_memory_bytes = peak_bytes - current_bytes
+        if stack:
+            stack[-1].max_traced_bytes = max(stack[-1].max_traced_bytes, peak_bytes)
+        tracemalloc.reset_peak()
+
+        with _RUN_LOCK:
+            if _RUN is not None:
+                _RUN["stages"].append(stage.to_dict())
+
+
+def profiled(name):
+    """
+    Decorator profiling every call of a function as a stage, with its row counts.
+
+    Returns the function itself when profiling is off.
+    """
+
+    def decorator(function):
+        if not PROFILING_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name) as stage:
+                result = function(*args, **kwargs)
+                stage.set_rows(list(args) + list(kwargs.values()), result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def profiled_run(name):
+    """
+    Decorator profiling every call of a function as a whole run, see profile_run.
+
+    Returns the function itself when profiling is off.
+    """
+
+    def decorator(function):
+        if not PROFILING_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_run(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profile_run(name, report_path=PROFILE_REPORT_PATH):
+    """
+    Profiles a whole run and writes its report to `report_path` as JSON.
+
+    A run started while another one is being profiled is recorded as a stage of it.
+    """
+    global _RUN
+    if not PROFILING_ENABLED:
+        yield
+        return
+    if _RUN is not None:
+        with profile_stage(name):
+            yield
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    with _RUN_LOCK:
+        _RUN = {
+            "run": name,
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "perf_started": time.perf_counter(),
+            "stages": [],
+        }
+    try:
+        with profile_stage(name):
+            yield
+    finally:
+        with _RUN_LOCK:
+            run, _RUN = _RUN, None
+        if started_tracing:
+            tracemalloc.stop()
+
+        # The run itself is the last stage closed, list the others in start order
+        total = run["stages"].pop()
+        run["stages"].sort(key=lambda stage: stage["offset_seconds"])
+        del run["perf_started"]
+        run.update(
+            {
+                "wall_seconds": total["wall_seconds"],
+                "cpu_seconds": total["cpu_seconds"],
+                "peak_memory_bytes": total["peak_memory_bytes"],
+            }
+        )
+        write_run_report(run, report_path)
+
+
+def write_run_report(report, report_path=PROFILE_REPORT_PATH):
+    path = Path(report_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_run_report(report_path=PROFILE_REPORT_PATH):
+    """
+    Returns the report of the last profiled run, or None.
+    """
+    try:
+        with open(report_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,196 @@
+import datetime
+import os
+import threading
+import traceback
+
+from pivoted_db import gen_db_df
+from pivoted_db import gen_db_df_incremental
+from storage import get_dataset_path
+from domain_index import StoredDomainIndex
+
+# Seconds between two refreshes of the progress while a regeneration is running
+REGENERATION_POLL_SECONDS = float(os.environ.get("REGENERATION_POLL_SECONDS", "1"))
+# Age in hours over which saved data is regenerated when the dashboard starts
+SAVED_DATA_MAX_AGE_HOURS = float(os.environ.get("SAVED_DATA_MAX_AGE_HOURS", "24"))
+
+
+def build_domain_index(incremental=False, pbar=None):
+    """
+    Generates the final DataFrame and indexes the "final" dataset it was written to.
+
+    Args:
+        incremental (bool): Only refresh the current date range of the last result.
+        pbar (optional): The progress bar of the run.
+
+    Returns:
+        StoredDomainIndex: The index of the new DataFrame.
+    """
+    if incremental:
+        gen_db_df_incremental(pbar=pbar)
+    else:
+        gen_db_df(pbar=pbar)
+    return StoredDomainIndex()
+
+
+def load_saved_domain_index(name="final"):
+    """
+    Returns the index of the saved final dataset and the time it was written, or
+    (None, None) when there is none.
+    """
+    path = get_dataset_path(name)
+    if not path.is_dir():
+        return None, None
+    saved_at = datetime.datetime.fromtimestamp(path.stat().st_mtime)
+    return StoredDomainIndex(name), saved_at
+
+
+class RegenerationProgress:
+    """
+    Progress of a regeneration, updated by the worker like a tqdm progress bar and
+    read by the dashboard reruns.
+    """
+
+    def __init__(self, incremental=False):
+        self.incremental = incremental
+        self.started_at = datetime.datetime.now()
+        self.description = "Starting"
+        self.total = None
+        self.n = 0
+
+    def reset(self, total=None):
+        self.n = 0
+        self.total = total
+
+    def set_description(self, desc=None):
+        self.description = desc or ""
+
+    def update(self, n=1):
+        self.n += n
+
+    def get_fraction(self):
+        """
+        Returns the share of the steps done, between 0 and 1.
+        """
+        if not self.total:
+            return 0.0
+        return min(self.n / self.total, 1.0)
+
+
+class Regenerator:
+    """
+    Regenerates the domain index in a background thread, while the last good index
+    keeps being served.
+
+    Every session reads the current index with get_snapshot, and the index reads the
+    rows of a domain from the "final" dataset. A regeneration replaces that dataset
+    as a whole once the new table is complete, so a domain is read either from the
+    old or the new table, never a mix, then swaps the new index in under the lock.
+    A failed regeneration keeps the old table. A regeneration requested while
+    another one is running joins it rather than starting a second run.
+    """
+
+    def __init__(self, build=build_domain_index):
+        self.build = build
+        self.domain_index = None
+        self.data_as_of = None
+        # Bumped on every swap, to key anything derived from the served index
+        self.version = 0
+        self.progress = None
+        self.error = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get_snapshot(self):
+        """
+        Returns the served index, the time its data was fetched and its version.
+        """
+        with self._lock:
+            return self.domain_index, self.data_as_of, self.version
+
+    def load_saved(self, name="final"):
+        """
+        Serves the saved final dataset until a regeneration completes.
+
+        Returns:
+            bool: Whether there was a saved result.
+        """
+        domain_index, saved_at = load_saved_domain_index(name)
+        if domain_index is None:
+            return False
+        with self._lock:
+            # Unless a regeneration completed meanwhile
+            if self.domain_index is None:
+                self.domain_index = domain_index
+                self.data_as_of = saved_at
+                self.version += 1
+        return True
+
+    def is_data_older_than(self, hours):
+        """
+        Returns whether there is no served data, or it is older than `hours`.
+        """
+        with self._lock:
+            data_as_of = self.data_as_of
+        if data_as_of is None:
+            return True
+        return datetime.datetime.now() - data_as_of > datetime.timedelta(hours=hours)
+
+    def request(self, incremental=False):
+        """
+        Starts a regeneration in a background thread, unless one is already running.
+
+        Args:
+            incremental (bool): Only refresh the current date range of the last result.
+                Ignored when the request joins a running regeneration.
+
+        Returns:
+            bool: Whether a new regeneration was started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self.progress = RegenerationProgress(incremental)
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(incremental, self.progress),
+                name="regeneration",
+                daemon=True,
+            )
+            self._thread.start()
+            return True
+
+    def is_running(self):
+        with self._lock:
+            return self._thread is not None
+
+    def wait(self, timeout=None):
+        """
+        Waits for the running regeneration, if any.
+
+        Returns:
+            bool: Whether no regeneration is running anymore.
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return not self.is_running()
+
+    def _run(self, incremental, progress):
+        try:
+            domain_index = self.build(incremental=incremental, pbar=progress)
+        except Exception as error:
+            traceback.print_exc()
+            with self._lock:
+                self.error = error
+                self.progress = None
+                self._thread = None
+            return
+
+        with self._lock:
+            self.domain_index = domain_index
+            self.data_as_of = progress.started_at
+            self.version += 1
+            self.error = None
+            self.progress = None
+            self._thread = None
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from searchconsole.account import Account
+
+# "record" captures the Search Console and sheet responses, "replay" serves them offline
+REPLAY_OFF = "off"
+REPLAY_RECORD = "record"
+REPLAY_REPLAY = "replay"
+REPLAY_MODE = os.environ.get("IO_REPLAY_MODE", REPLAY_OFF)
+# Archive of the captured responses
+REPLAY_ARCHIVE_PATH = os.environ.get("IO_REPLAY_ARCHIVE", "replay/archive.zip")
+# Seconds every replayed response waits, or "recorded" for the latency of its capture
+REPLAY_LATENCY = os.environ.get("IO_REPLAY_LATENCY", "0")
+
+_ARCHIVE = None
+_ARCHIVE_LOCK = threading.Lock()
+
+
+class ReplayArchive:
+    """
+    Zip archive of captured responses, one deflated entry per request.
+
+    Entries are named by a hash of the request, and their comment keeps the request
+    and the seconds it took when it was captured. A recording starts a new archive
+    on its first capture, and a request already captured by it is not stored again.
+    """
+
+    def __init__(self, path=REPLAY_ARCHIVE_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._recorded = None
+        self._reader = None
+
+    @staticmethod
+    def make_name(key_parts):
+        key = json.dumps(key_parts, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def record(self, key_parts, payload, seconds):
+        """
+        Stores the payload of a request, unless this recording already stored it.
+        """
+        name = self.make_name(key_parts)
+        with self._lock:
+            if self._recorded is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self.path.unlink(missing_ok=True)
+                self._recorded = set()
+            if name in self._recorded:
+                return
+
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.comment = json.dumps(
+                {"key": key_parts, "seconds": round(seconds, 6)}, default=str
+            ).encode("utf-8")
+            with zipfile.ZipFile(self.path, "a") as archive:
+                archive.writestr(info, payload)
+            self._recorded.add(name)
+
+    def load(self, key_parts):
+        """
+        Returns the payload of a request and the seconds it took when it was captured.
+        """
+        name = self.make_name(key_parts)
+        with self._lock:
+            if self._reader is None:
+                if not self.path.is_file():
+                    raise LookupError(
+                        f"No replay archive at {self.path}, "
+                        f"capture one with IO_REPLAY_MODE={REPLAY_RECORD}"
+                    )
+                self._reader = zipfile.ZipFile(self.path, "r")
+            try:
+                info = self._reader.getinfo(name)
+            except KeyError:
+                raise LookupError(
+                    f"No captured response for {key_parts} in {self.path}, "
+                    f"capture it with IO_REPLAY_MODE={REPLAY_RECORD}"
+                ) from None
+            return self._reader.read(info), json.loads(info.comment)["seconds"]
+
+
+def get_replay_archive():
+    global _ARCHIVE
+    with _ARCHIVE_LOCK:
+        if _ARCHIVE is None:
+            _ARCHIVE = ReplayArchive()
+    return _ARCHIVE
+
+
+def record_response(key_parts, payload, seconds):
+    get_replay_archive().record(key_parts, payload, seconds)
+
+
+def replay_response(key_parts):
+    """
+    Returns the captured payload of a request, after the simulated latency.
+    """
+    payload, seconds = get_replay_archive().load(key_parts)
+    latency = seconds if REPLAY_LATENCY == "recorded" else float(REPLAY_LATENCY)
+    if latency > 0:
+        time.sleep(latency)
+    return payload
+
+
+class _RecordingRequest:
+    def __init__(self, key_parts, request):
+        self.key_parts = key_parts
+        self.request = request
+
+    def execute(self):
+        started = time.perf_counter()
+        response = self.request.execute()
+        record_response(
+            self.key_parts,
+            json.dumps(response).encode("utf-8"),
+            time.perf_counter() - started,
+        )
+        return response
+
+
+class _ReplayRequest:
+    def __init__(self, key_parts):
+        self.key_parts = key_parts
+
+    def execute(self):
+        return json.loads(replay_response(self.key_parts))
+
+
+class ReplayService:
+    """
+    Search Console API client capturing the responses of `service`, or replaying
+    the captured responses without credentials when `service` is None.
+
+    Covers the web property listing and the Search Analytics queries, each page of
+    a query being a request of its own.
+    """
+
+    def __init__(self, service=None):
+        self.service = service
+
+    def _request(self, key_parts, make_request):
+        if self.service is None:
+            return _ReplayRequest(key_parts)
+        return _RecordingRequest(key_parts, make_request())
+
+    def sites(self):
+        client = self
+
+        class Sites:
+            def list(self):
+                return client._request(
+                    ["sites.list"], lambda: client.service.sites().list()
+                )
+
+        return Sites()
+
+    def searchanalytics(self):
+        client = self
+
+        class SearchAnalytics:
+            def query(self, siteUrl, body):
+                return client._request(
+                    ["searchanalytics.query", siteUrl, body],
+                    lambda: client.service.searchanalytics().query(
+                        siteUrl=siteUrl, body=body
+                    ),
+                )
+
+        return SearchAnalytics()
+
+
+def get_replay_account():
+    """
+    Returns a Search Console account replaying the captured responses.
+    """
+    return Account(ReplayService(), credentials=None)
+
+
+def record_account(account):
+    """
+    Makes an authenticated Search Console account capture every response it receives.
+    """
+    account.service = ReplayService(account.service)
+    return account
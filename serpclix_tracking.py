@@ -1,7 +1,8 @@
-import country_converter as coco
 from searchconsole import authenticate
 from pathlib import Path
 import pandas as pd
+from utils import convert_countries
+from utils import compact_dtypes
 
 
 def add_source_column_serpclix(df: pd.DataFrame) -> pd.DataFrame:
@@ -51,8 +52,9 @@ def convert_country_to_iso2(df: pd.DataFrame) -> pd.DataFrame:
         pd.DataFrame: A DataFrame with the converted "country" values.
     """
 
-    df["country"] = df["country"].apply(
-        lambda x: coco.convert(names=x, to="ISO2") if x else x
+    # Convert every unique country once, leaving empty values as they are
+    df["country"] = convert_countries(df["country"], to="ISO2").where(
+        df["country"].map(bool), df["country"]
     )
     return df
 
@@ -146,13 +148,14 @@ def drop_na_rows(df: pd.DataFrame) -> pd.DataFrame:
 
 
 def process_click_tracking_data_serpclix(
-    click_tracking_df: pd.DataFrame, date_ranges: list
+    click_tracking_df: pd.DataFrame, date_ranges: list, stage: str = "serpclix_tracking"
 ) -> pd.DataFrame:
     """
     Processes the click tracking data for SerpClix and returns a cleaned DataFrame.
 
     Args:
         click_tracking_df (pd.DataFrame): A DataFrame containing click tracking data for SerpClix.
+        stage (str, optional): The stage name of the memory report, None to skip the report.
 
     Returns:
         pd.DataFrame: A cleaned DataFrame containing only the "query", "country", "date", "page", and "source" columns.
@@ -185,6 +188,7 @@ def process_click_tracking_data_serpclix(
     # click_tracking_df.to_csv("serpclix_9.csv", index=False, encoding="utf-8", sep="\t")
 
     # click_tracking_df = add_date_range_column_and_clean(click_tracking_df, date_ranges)
+    click_tracking_df = compact_dtypes(click_tracking_df, stage=stage)
     return click_tracking_df
 
 
@@ -0,0 +1,294 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import unquote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from utils import compact_dtypes
+
+# Root directory of the Parquet datasets
+DATA_STORE_DIR = os.environ.get("DATA_STORE_DIR", "data")
+# Compression codec of the Parquet files
+PARQUET_COMPRESSION = "zstd"
+# Directory name of the partition of the rows whose partition column is missing
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+RANK_COLUMNS = [
+    "Current Rank",
+    "Previous Rank 1",
+    "Previous Rank 2",
+    "Previous Rank 3",
+    "Previous Rank 4",
+    "Previous Rank 5",
+]
+
+FINAL_SCHEMA = pa.schema(
+    [("Keyword", pa.string()), ("Page", pa.string())]
+    + [(column, pa.float32()) for column in RANK_COLUMNS]
+    + [
+        ("Impressions", pa.int32()),
+        ("Clicks", pa.int32()),
+        ("Average Position", pa.float32()),
+        ("In House Clicks", pa.int32()),
+        ("SerpClix", pa.int32()),
+        ("Adjusted Clicks", pa.int32()),
+        ("Country", pa.string()),
+        ("Date Last Updated Interval", pa.string()),
+        ("Domain", pa.string()),
+    ]
+)
+
+# Typed schema and partition columns of each dataset. A schema of None is inferred.
+DATASETS = {
+    # Cleaned Search Console rows from gsc.get_gsc_data_df
+    "gsc": {
+        "schema": pa.schema(
+            [
+                ("query", pa.string()),
+                ("page", pa.string()),
+                ("country", pa.string()),
+                ("clicks", pa.int32()),
+                ("impressions", pa.int32()),
+                ("position", pa.float32()),
+                ("domain", pa.string()),
+                ("date_range", pa.string()),
+            ]
+        ),
+        "partition_cols": ["domain", "date_range"],
+    },
+    # Click counts from click_tracking.get_click_data_df
+    "click_data": {
+        "schema": pa.schema(
+            [
+                ("query", pa.string()),
+                ("country", pa.string()),
+                ("page", pa.string()),
+                ("date_range", pa.string()),
+                ("in_house_clicks", pa.float32()),
+                ("serpclix_clicks", pa.float32()),
+                ("source", pa.string()),
+                ("domain", pa.string()),
+            ]
+        ),
+        "partition_cols": ["domain", "date_range"],
+    },
+    # Daily Search Console facts of the "daily" fetch mode, from gsc.get_gsc_daily_dataframes
+    "daily_facts": {
+        "schema": pa.schema(
+            [
+                ("web_property", pa.string()),
+                ("query", pa.string()),
+                ("page", pa.string()),
+                ("country", pa.string()),
+                ("date", pa.date32()),
+                ("clicks", pa.int32()),
+                ("impressions", pa.int32()),
+                # Full precision, the date ranges average it again
+                ("position", pa.float64()),
+            ]
+        ),
+        "partition_cols": ["web_property", "date"],
+    },
+    # Merged rows combined with the pivoted ranks, step 10 of pivoted_db.gen_db_df
+    "combined": {"schema": None, "partition_cols": ["domain"]},
+    # Final table before and after the filter rules
+    "final_unfiltered": {"schema": FINAL_SCHEMA, "partition_cols": ["Domain"]},
+    "final": {"schema": FINAL_SCHEMA, "partition_cols": ["Domain"]},
+}
+
+
+def get_dataset_path(name: str) -> Path:
+    """
+    Returns the directory of a dataset.
+    """
+    return Path(DATA_STORE_DIR) / name
+
+
+def get_partitioning(name: str):
+    """
+    Returns the hive partitioning of a dataset, typed from its schema.
+    Partition columns of datasets without a schema are strings.
+    """
+    schema = DATASETS[name]["schema"]
+    partition_cols = DATASETS[name]["partition_cols"]
+    return ds.partitioning(
+        pa.schema(
+            [
+                schema.field(column) if schema is not None else (column, pa.string())
+                for column in partition_cols
+            ]
+        ),
+        flavor="hive",
+    )
+
+
+def to_arrow_table(df: pd.DataFrame, name: str) -> pa.Table:
+    """
+    Converts a DataFrame to an Arrow table with the schema of a dataset.
+
+    Columns that are not in the schema are dropped. Datasets without a schema keep
+    every column with inferred types.
+    """
+    schema = DATASETS[name]["schema"]
+    if schema is None:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    return pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+
+def get_inputs_path(name: str) -> Path:
+    """
+    Returns the file recording the inputs a dataset was built from.
+
+    Its name starts with "_", so dataset discovery skips it.
+    """
+    return get_dataset_path(name) / "_inputs.json"
+
+
+def write_dataset(
+    df: pd.DataFrame, name: str, overwrite: bool = True, inputs: dict = None
+):
+    """
+    Writes a DataFrame to a compressed Parquet dataset partitioned by its partition columns.
+
+    Args:
+        df (pd.DataFrame): The rows to write.
+        name (str): The name of the dataset in DATASETS.
+        overwrite (bool): Replace the whole dataset. It is written next to the current
+            one and swapped in once complete, so readers never see it half written.
+            Otherwise only the partitions present in `df` are replaced in place.
+        inputs (dict, optional): A JSON fingerprint of the inputs the rows were built
+            from, returned by read_dataset_inputs.
+    """
+    path = get_dataset_path(name)
+    write_path = path.with_name(f".{path.name}.new") if overwrite else path
+    if overwrite:
+        shutil.rmtree(write_path, ignore_errors=True)
+    write_path.mkdir(parents=True, exist_ok=True)
+
+    table = to_arrow_table(df, name)
+    for column in DATASETS[name]["partition_cols"]:
+        index = table.schema.get_field_index(column)
+        table = table.set_column(index, column, table[column].cast(pa.string()))
+
+    ds.write_dataset(
+        table,
+        write_path,
+        format="parquet",
+        partitioning=get_partitioning(name),
+        existing_data_behavior="delete_matching",
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression=PARQUET_COMPRESSION
+        ),
+    )
+
+    inputs_path = write_path / get_inputs_path(name).name
+    if inputs is None:
+        inputs_path.unlink(missing_ok=True)
+    else:
+        with open(inputs_path, "w", encoding="utf-8") as file:
+            json.dump(inputs, file)
+
+    if overwrite:
+        old_path = path.with_name(f".{path.name}.old")
+        shutil.rmtree(old_path, ignore_errors=True)
+        if path.exists():
+            os.replace(path, old_path)
+        os.replace(write_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_dataset_inputs(name: str):
+    """
+    Returns the inputs fingerprint a dataset was written with, or None.
+    """
+    try:
+        with open(get_inputs_path(name), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def get_filter_expression(filters: dict):
+    """
+    Returns the dataset expression keeping the rows of `filters`, Column -> value or
+    list of values, or None to keep every row.
+    """
+    expression = None
+    for column, values in (filters or {}).items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        condition = pc.field(column).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_dataset(
+    name: str, columns: list = None, filters: dict = None, compact: bool = True
+):
+    """
+    Reads a Parquet dataset, loading only the requested partitions and columns.
+
+    Args:
+        name (str): The name of the dataset in DATASETS.
+        columns (list, optional): The columns to load. None loads every column.
+        filters (dict, optional): Column -> value or list of values to keep. Filters on
+            partition columns skip the other partitions without reading them.
+        compact (bool): Convert the columns to the compact dtypes of the pipeline.
+            Otherwise they keep the types of the schema.
+
+    Returns:
+        pd.DataFrame: The rows, or None if the dataset has not been written yet.
+    """
+    path = get_dataset_path(name)
+    if not path.exists():
+        return None
+
+    dataset = ds.dataset(path, format="parquet", partitioning=get_partitioning(name))
+    table = dataset.to_table(columns=columns, filter=get_filter_expression(filters))
+    # Partition columns come last when read back, restore the order of the schema
+    schema = DATASETS[name]["schema"]
+    if columns is None and schema is not None:
+        table = table.select(schema.names)
+    df = table.to_pandas()
+    return compact_dtypes(df) if compact else df
+
+
+def list_partition_values(name: str, column: str) -> list:
+    """
+    Returns the values of a partition column, read from the directory names only.
+    """
+    path = get_dataset_path(name)
+    if not path.exists():
+        return []
+
+    prefix = f"{column}="
+    values = set()
+    for directory in path.rglob(f"{prefix}*"):
+        if directory.is_dir():
+            values.add(unquote(directory.name[len(prefix) :]))
+    # Rows without a value are written to the default partition
+    values.discard(HIVE_NULL_PARTITION)
+    return sorted(values)
+
+
+def delete_partitions(name: str, filters: dict):
+    """
+    Deletes the partitions of a dataset matching `filters`, Column -> value or list of
+    values of its partition columns.
+    """
+    path = get_dataset_path(name)
+    if not path.exists():
+        return
+
+    dataset = ds.dataset(path, format="parquet", partitioning=get_partitioning(name))
+    for fragment in dataset.get_fragments(filter=get_filter_expression(filters)):
+        os.remove(fragment.path)
+        # Remove the partition directories left empty
+        directory = Path(fragment.path).parent
+        while directory != path and not any(directory.iterdir()):
+            directory.rmdir()
+            directory = directory.parent
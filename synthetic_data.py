@@ -0,0 +1,378 @@
+import math
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from searchconsole.account import Account
+from utils import get_date_ranges
+
+# Countries of the synthetic rows: name, ISO2 and the lowercase ISO3 Search Console returns
+SYNTHETIC_COUNTRIES = [
+    ("United States", "US", "usa"),
+    ("Canada", "CA", "can"),
+    ("United Kingdom", "GB", "gbr"),
+    ("Germany", "DE", "deu"),
+    ("Australia", "AU", "aus"),
+    ("France", "FR", "fra"),
+    ("Netherlands", "NL", "nld"),
+    ("Sweden", "SE", "swe"),
+    ("Singapore", "SG", "sgp"),
+    ("Spain", "ES", "esp"),
+    ("Italy", "IT", "ita"),
+    ("Ireland", "IE", "irl"),
+]
+# Share of the keyword and country pairs of a domain that appear in each date range
+GSC_ROW_DENSITY = 0.8
+# Share of the clicks of the synthetic rows
+GSC_CLICK_RATE = 0.05
+# Number of Search Console responses kept in memory to serve their following pages
+FAKE_GSC_CACHE_SIZE = 16
+
+
+class SyntheticScenario:
+    """
+    Deterministic synthetic inputs of the pipeline at a given scale.
+
+    The Search Console rows, click logs, Ahrefs domains and filter rules share the
+    same keywords, pages and countries, so the merges and pivots match rows like they
+    do on real data. `rows` is the total number of Search Console rows over every
+    domain and date range.
+    """
+
+    def __init__(self, rows, domains=5, countries=4, click_rows=None, seed=0):
+        if not 1 <= countries <= len(SYNTHETIC_COUNTRIES):
+            raise ValueError(
+                f"countries must be between 1 and {len(SYNTHETIC_COUNTRIES)}"
+            )
+        self.rows = rows
+        self.click_rows = rows // 10 if click_rows is None else click_rows
+        self.seed = seed
+        self.domains = [f"domain{index}.com" for index in range(domains)]
+        self.countries = SYNTHETIC_COUNTRIES[:countries]
+        self.date_ranges = get_date_ranges()
+
+        self.rows_per_query = math.ceil(rows / (domains * len(self.date_ranges)))
+        self.keywords_per_domain = math.ceil(
+            self.rows_per_query / GSC_ROW_DENSITY / countries
+        )
+        self._keywords = np.array(
+            [f"keyword {index}" for index in range(self.keywords_per_domain)],
+            dtype=object,
+        )
+
+    @property
+    def name(self):
+        return (
+            f"rows={self.rows},domains={len(self.domains)},"
+            f"countries={len(self.countries)},click_rows={self.click_rows}"
+        )
+
+    def _get_rng(self, *parts):
+        key = zlib.crc32("|".join(str(part) for part in parts).encode("utf-8"))
+        return np.random.default_rng([self.seed, key])
+
+    def _get_pages(self, domains, keyword_indices, scheme="https://", slash="/"):
+        return (
+            pd.Series(domains, dtype=object).radd(scheme)
+            + "/services/keyword-"
+            + pd.Series(keyword_indices).astype(str)
+            + slash
+        ).to_numpy(dtype=object)
+
+    def _get_click_days(self, rng, size):
+        first_day = self.date_ranges[-1][1]
+        days = (self.date_ranges[0][0] - first_day).days
+        return first_day + pd.to_timedelta(rng.integers(0, days, size), unit="D")
+
+    def generate_gsc_rows(
+        self, domain, start_date, end_date, dimensions=("query", "page", "country")
+    ):
+        """
+        Returns the Search Console rows of a domain between two days.
+
+        Args:
+            domain (str): The domain of the web property.
+            start_date (str): The first day of the query.
+            end_date (str): The last day of the query.
+            dimensions (tuple): The dimensions of the query. "date" spreads the rows
+                over the days of the query.
+
+        Returns:
+            pd.DataFrame: The dimension columns and clicks, impressions, ctr and position.
+        """
+        rng = self._get_rng("gsc", domain, start_date, end_date)
+        n_countries = len(self.countries)
+        pairs = self.keywords_per_domain * n_countries
+        pairs = np.sort(
+            rng.choice(pairs, size=min(self.rows_per_query, pairs), replace=False)
+        )
+        keyword_indices = pairs // n_countries
+        country_indices = pairs % n_countries
+
+        impressions = rng.integers(1, 1000, len(pairs))
+        clicks = rng.binomial(impressions, GSC_CLICK_RATE)
+        rows_df = pd.DataFrame(
+            {
+                "query": self._keywords[keyword_indices],
+                "page": self._get_pages(
+                    np.full(len(pairs), domain, dtype=object), keyword_indices
+                ),
+                "country": np.array([country[2] for country in self.countries])[
+                    country_indices
+                ],
+                "clicks": clicks,
+                "impressions": impressions,
+                "ctr": clicks / impressions,
+                "position": rng.uniform(1, 60, len(pairs)).round(2),
+            }
+        )
+        if "date" in dimensions:
+            days = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1
+            rows_df["date"] = (
+                pd.Timestamp(start_date)
+                + pd.to_timedelta(rng.integers(0, days, len(pairs)), unit="D")
+            ).strftime("%Y-%m-%d")
+        return rows_df[list(dimensions) + ["clicks", "impressions", "ctr", "position"]]
+
+    def generate_in_house_clicks(self):
+        """
+        Returns the in-house link clicking sheet, one row per click.
+        """
+        rng = self._get_rng("in_house")
+        size = self.click_rows
+        domain_indices = rng.integers(0, len(self.domains), size)
+        keyword_indices = rng.integers(0, self.keywords_per_domain, size)
+        country_indices = rng.integers(0, len(self.countries), size)
+        domains = np.array(self.domains, dtype=object)[domain_indices]
+        rankings = rng.integers(1, 30, size).astype(str).astype(object)
+        # Some clicks were not ranked, the pipeline drops them
+        rankings[rng.random(size) < 0.05] = "-"
+
+        return pd.DataFrame(
+            {
+                "Keyword": self._keywords[keyword_indices],
+                "Site": domains,
+                "Location": "",
+                "Ranking": rankings,
+                "Map Pack": "",
+                "Date": self._get_click_days(rng, size).strftime("%Y-%m-%d"),
+                "VPN": np.array([f"{country[1]} City" for country in self.countries])[
+                    country_indices
+                ],
+                "IP Address": "127.0.0.1",
+                "Link": self._get_pages(domains, keyword_indices),
+                "Wrong Link": "",
+                "Exit": "",
+            }
+        )
+
+    def generate_serpclix_clicks(self):
+        """
+        Returns the SerpClix link clicking sheet, one row per click.
+        """
+        rng = self._get_rng("serpclix")
+        size = self.click_rows
+        domain_indices = rng.integers(0, len(self.domains), size)
+        keyword_indices = rng.integers(0, self.keywords_per_domain, size)
+        country_indices = rng.integers(0, len(self.countries), size)
+        timestamps = self._get_click_days(rng, size) + pd.to_timedelta(
+            rng.integers(0, 24 * 60 * 60, size), unit="s"
+        )
+
+        return pd.DataFrame(
+            {
+                "Order ID": np.arange(size),
+                "Timestamp": timestamps.strftime("%Y-%m-%d %H:%M:%S+00:00"),
+                "URL": self._get_pages(
+                    np.array(self.domains, dtype=object)[domain_indices],
+                    keyword_indices,
+                    scheme="",
+                    slash="",
+                ),
+                "Keyword": self._keywords[keyword_indices],
+                "Clicker Country": np.array([country[0] for country in self.countries])[
+                    country_indices
+                ],
+                "Clicker IP": "127.xxx.xxx.1",
+            }
+        )
+
+    def generate_ahrefs_domains(self):
+        """
+        Returns the Ahrefs domain sheet, every domain tracked in every country.
+        """
+        countries = ", ".join(country[0] for country in self.countries)
+        return pd.DataFrame(
+            {
+                "Client": [domain.split(".")[0].title() for domain in self.domains],
+                "Domain": self.domains,
+                "Ahrefs Account": "NA",
+                "Country": countries,
+            }
+        )
+
+    def generate_filter_rules(self):
+        """
+        Returns the filter rules: one blacklisted keyword per domain, every other row kept.
+        """
+        rules = [
+            [f"keyword {index + 1}", domain, "Blacklist"]
+            for index, domain in enumerate(self.domains)
+        ]
+        rules.append(["keyword", "All", "Whitelist"])
+        return pd.DataFrame(rules, columns=["Keyword", "Domain", "Filter Type"])
+
+    def write_gsheets(self, directory):
+        """
+        Writes the sheets of the scenario as CSV files in `directory`.
+
+        Returns:
+            dict: The path of each sheet, by the name it is registered with.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        sheets = {
+            "ahrefs_domain": self.generate_ahrefs_domains(),
+            "in_house_link_clicking": self.generate_in_house_clicks(),
+            "serpclix_link_clicking": self.generate_serpclix_clicks(),
+            "filter_rules": self.generate_filter_rules(),
+        }
+        paths = {}
+        for name, sheet_df in sheets.items():
+            paths[name] = str(directory / f"{name}.csv")
+            sheet_df.to_csv(paths[name], index=False, encoding="utf-8")
+        return paths
+
+    def make_account(self, creds_path=None, latency=0.0):
+        """
+        Returns a Search Console account serving the rows of the scenario, see
+        FakeSearchConsoleService. Takes the place of gsc.authenticate_account.
+        """
+        return Account(FakeSearchConsoleService(self, latency), credentials=None)
+
+
+class _FakeRequest:
+    def __init__(self, function, latency=0.0):
+        self.function = function
+        self.latency = latency
+
+    def execute(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.function()
+
+
+class FakeSearchConsoleService:
+    """
+    Offline stand-in for the Search Console API client of a SyntheticScenario.
+
+    Lists a domain property for every domain of the scenario and answers Search
+    Analytics queries page by page, with the dimensions, country filter, startRow
+    and rowLimit of the request. Every request waits `latency` seconds.
+    """
+
+    def __init__(self, scenario, latency=0.0):
+        self.scenario = scenario
+        self.latency = latency
+        self.calls = 0
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def sites(self):
+        service = self
+
+        class Sites:
+            def list(self):
+                return _FakeRequest(service.list_sites, service.latency)
+
+        return Sites()
+
+    def searchanalytics(self):
+        service = self
+
+        class SearchAnalytics:
+            def query(self, siteUrl, body):
+                return _FakeRequest(
+                    lambda: service.query(siteUrl, body), service.latency
+                )
+
+        return SearchAnalytics()
+
+    def list_sites(self):
+        return {
+            "siteEntry": [
+                {"siteUrl": f"sc-domain:{domain}", "permissionLevel": "siteOwner"}
+                for domain in self.scenario.domains
+            ]
+        }
+
+    def _get_rows(self, site_url, body):
+        dimensions = tuple(body.get("dimensions", []))
+        countries = [
+            condition["expression"].lower()
+            for group in body.get("dimensionFilterGroups", [])
+            for condition in group.get("filters", [])
+            if condition.get("dimension") == "country"
+        ]
+        key = (site_url, body["startDate"], body["endDate"], dimensions, *countries)
+
+        with self._lock:
+            if key in self._responses:
+                self._responses.move_to_end(key)
+                return self._responses[key]
+
+        domain = site_url.replace("sc-domain:", "").split("//")[-1].strip("/")
+        rows_df = self.scenario.generate_gsc_rows(
+            domain,
+            body["startDate"],
+            body["endDate"],
+            tuple(set(dimensions) | {"country"}),
+        )
+        for country in countries:
+            rows_df = rows_df[rows_df["country"] == country]
+        rows_df = rows_df[
+            list(dimensions) + ["clicks", "impressions", "ctr", "position"]
+        ]
+
+        with self._lock:
+            self._responses[key] = rows_df
+            while len(self._responses) > FAKE_GSC_CACHE_SIZE:
+                self._responses.popitem(last=False)
+        return rows_df
+
+    def query(self, site_url, body):
+        """
+        Returns the Search Analytics response of a query, in the format of the API.
+        """
+        with self._lock:
+            self.calls += 1
+        rows_df = self._get_rows(site_url, body)
+        start_row = body.get("startRow", 0)
+        page_df = rows_df.iloc[start_row : start_row + body.get("rowLimit", 25000)]
+        if page_df.empty:
+            return {}
+
+        dimensions = list(page_df.columns[:-4])
+        keys = zip(*(page_df[column].tolist() for column in dimensions))
+        return {
+            "rows": [
+                {
+                    "keys": list(key),
+                    "clicks": clicks,
+                    "impressions": impressions,
+                    "ctr": ctr,
+                    "position": position,
+                }
+                for key, clicks, impressions, ctr, position in zip(
+                    keys,
+                    page_df["clicks"].tolist(),
+                    page_df["impressions"].tolist(),
+                    page_df["ctr"].tolist(),
+                    page_df["position"].tolist(),
+                )
+            ]
+        }
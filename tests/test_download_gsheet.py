@@ -0,0 +1,134 @@
+"""
+Checks the conditional sheet downloads of utils.download_gsheet against a local
+HTTP stand-in for the Google Sheets CSV export, served on GSHEET_EXPORT_BASE_URL.
+
+The stand-in answers If-None-Match with 304 when it is asked to, and records the
+headers of every request.
+"""
+
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import utils
+from utils import GSHEET_CHANGED
+from utils import GSHEET_UNCHANGED
+from utils import download_gsheet
+from utils import load_gsheet_state
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/document-id/edit#gid=123"
+
+
+class SheetExport:
+    """
+    The sheet served by the stand-in, and the requests it received.
+    """
+
+    def __init__(self):
+        self.body = b"Keyword,Domain,Filter Type\nshoes,All,Whitelist\n"
+        self.honor_conditional = True
+        self.requests = []
+
+    @property
+    def etag(self):
+        return f'"{hashlib.md5(self.body).hexdigest()}"'
+
+
+@pytest.fixture
+def sheet_export(monkeypatch):
+    export = SheetExport()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            export.requests.append((self.path, dict(self.headers)))
+            if (
+                export.honor_conditional
+                and self.headers.get("If-None-Match") == export.etag
+            ):
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(export.body)))
+            self.send_header("ETag", export.etag)
+            self.send_header("Last-Modified", "Mon, 01 May 2023 00:00:00 GMT")
+            self.end_headers()
+            self.wfile.write(export.body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        utils, "GSHEET_EXPORT_BASE_URL", f"http://127.0.0.1:{server.server_port}"
+    )
+    yield export
+    server.shutdown()
+    server.server_close()
+
+
+def test_first_download_writes_sheet_and_state(sheet_export, tmp_path):
+    path = tmp_path / "gsheet" / "filter_rules.csv"
+
+    assert download_gsheet(SHEET_URL, str(path)) == GSHEET_CHANGED
+
+    assert path.read_bytes() == sheet_export.body
+    request_path, headers = sheet_export.requests[0]
+    assert request_path == "/document-id/export?format=csv&gid=123"
+    assert "If-None-Match" not in headers
+    state = load_gsheet_state(str(path))
+    assert state["etag"] == sheet_export.etag
+    assert state["last_modified"] == "Mon, 01 May 2023 00:00:00 GMT"
+    assert state["sha256"] == hashlib.sha256(sheet_export.body).hexdigest()
+
+
+def test_not_modified_keeps_file(sheet_export, tmp_path):
+    path = tmp_path / "filter_rules.csv"
+    download_gsheet(SHEET_URL, str(path))
+    os.utime(path, (0, 0))
+
+    assert download_gsheet(SHEET_URL, str(path)) == GSHEET_UNCHANGED
+
+    _, headers = sheet_export.requests[-1]
+    assert headers["If-None-Match"] == sheet_export.etag
+    assert headers["If-Modified-Since"] == "Mon, 01 May 2023 00:00:00 GMT"
+    assert path.stat().st_mtime == 0
+    assert path.read_bytes() == sheet_export.body
+
+
+def test_same_content_is_not_rewritten(sheet_export, tmp_path):
+    path = tmp_path / "filter_rules.csv"
+    download_gsheet(SHEET_URL, str(path))
+    os.utime(path, (0, 0))
+    # The export sends the whole sheet again, with the same content
+    sheet_export.honor_conditional = False
+
+    assert download_gsheet(SHEET_URL, str(path)) == GSHEET_UNCHANGED
+
+    assert path.stat().st_mtime == 0
+    assert not (tmp_path / "filter_rules.csv.part").exists()
+
+
+def test_changed_sheet_replaces_file(sheet_export, tmp_path):
+    path = tmp_path / "filter_rules.csv"
+    download_gsheet(SHEET_URL, str(path))
+    sheet_export.body += b"boots,All,Blacklist\n"
+
+    assert download_gsheet(SHEET_URL, str(path)) == GSHEET_CHANGED
+
+    assert path.read_bytes() == sheet_export.body
+    state = load_gsheet_state(str(path))
+    assert state["etag"] == sheet_export.etag
+    assert state["sha256"] == hashlib.sha256(sheet_export.body).hexdigest()
+
+
+def test_rejects_urls_other_than_google_sheets(tmp_path):
+    with pytest.raises(ValueError):
+        download_gsheet("https://example.com/sheet.csv", str(tmp_path / "sheet.csv"))
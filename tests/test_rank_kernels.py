@@ -0,0 +1,185 @@
+"""
+Compares the vectorized rank kernels of pivoted_db with the apply-based kernels
+they replaced, on merged frames built from the sample click tracking sheets.
+
+The samples have no Search Console export, so the GSC rows of the sampled
+keywords are generated with a fixed seed, leaving some keywords without GSC
+rows or without click tracking, and some date ranges without a rank. The legacy
+kernels run on the float64 columns the pipeline had before the dtype policy.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import click_tracking
+from pivoted_db import GEN_DB_DAG
+from pivoted_db import add_average_rank
+from pivoted_db import create_first_rank_column
+from pivoted_db import get_adjusted_clicks
+from utils import compact_dtypes
+from utils import get_date_range_labels
+from utils import get_date_ranges
+
+# The sample sheets run until April 2023
+SAMPLE_TODAY = pd.Timestamp("2023-05-01")
+SAMPLE_GSHEETS = {
+    "in_house_link_clicking": "gsheet/in_house_link_clicking.csv",
+    "serpclix_link_clicking": "gsheet/serpclix_link_clicking.csv",
+}
+RANK_COLUMNS = [
+    "current_rank",
+    "previous_rank_1",
+    "previous_rank_2",
+    "previous_rank_3",
+    "previous_rank_4",
+    "previous_rank_5",
+]
+
+
+def to_legacy_dtypes(df):
+    """
+    Widens the compact count and rank columns back to float64. Positions have a
+    single decimal, which float32 only approximates.
+    """
+    columns = [
+        column
+        for column in ["clicks", "in_house_clicks", "serpclix_clicks", "position"]
+        + RANK_COLUMNS
+        if column in df
+    ]
+    return df.astype({column: "float64" for column in columns}).round(
+        {column: 1 for column in columns}
+    )
+
+
+def legacy_adjusted_clicks(df):
+    return df.apply(
+        lambda row: (
+            row["clicks"] - row["in_house_clicks"] - row["serpclix_clicks"]
+            if not pd.isnull(row["in_house_clicks"])
+            and not pd.isnull(row["serpclix_clicks"])
+            else row["clicks"]
+        ),
+        axis=1,
+    )
+
+
+def legacy_first_rank(df):
+    def get_first_rank(row):
+        for col in RANK_COLUMNS:
+            if not pd.isnull(row[col]):
+                return row[col]
+        return np.nan
+
+    return df.apply(get_first_rank, axis=1)
+
+
+def legacy_average_rank(df):
+    return df[RANK_COLUMNS].apply(lambda x: np.nanmean(x), axis=1).round(decimals=1)
+
+
+def assert_same_values(expected, actual):
+    """
+    Asserts that two Series are equal in the dtype of `actual`, and bitwise
+    identical once widened to float64, missing values included.
+    """
+    expected = expected.astype(actual.dtype)
+    assert expected.equals(actual)
+
+    expected = expected.to_numpy(dtype="float64", na_value=np.nan)
+    actual = actual.to_numpy(dtype="float64", na_value=np.nan)
+    assert np.array_equal(np.isnan(expected), np.isnan(actual))
+    valid = ~np.isnan(expected)
+    assert np.array_equal(expected[valid].view(np.int64), actual[valid].view(np.int64))
+
+
+def make_gsc_df(click_data_df, date_range_labels, seed=0):
+    """
+    Generates GSC rows for most keywords of the sampled click data, in some of the
+    date ranges of each keyword.
+    """
+    rng = np.random.default_rng(seed)
+    keys_df = (
+        click_data_df[["query", "page", "country", "domain"]]
+        .astype(str)
+        .drop_duplicates()
+    )
+    keys_df = keys_df[rng.random(len(keys_df)) < 0.85]
+    gsc_df = keys_df.merge(pd.DataFrame({"date_range": date_range_labels}), how="cross")
+    gsc_df = gsc_df[rng.random(len(gsc_df)) < 0.7].reset_index(drop=True)
+    gsc_df["clicks"] = rng.integers(0, 40, len(gsc_df))
+    gsc_df["impressions"] = gsc_df["clicks"] + rng.integers(1, 900, len(gsc_df))
+    gsc_df["position"] = rng.uniform(1, 60, len(gsc_df)).round(1)
+    return compact_dtypes(gsc_df)
+
+
+@pytest.fixture(scope="module")
+def sample_frames(tmp_path_factory, request):
+    """
+    Returns the intermediate frames of the pipeline run on the sample sheets.
+    """
+    monkeypatch = pytest.MonkeyPatch()
+    request.addfinalizer(monkeypatch.undo)
+    sample_paths = {
+        name: str(request.config.rootpath / path)
+        for name, path in SAMPLE_GSHEETS.items()
+    }
+    # Stored datasets go to a temporary directory
+    monkeypatch.chdir(tmp_path_factory.mktemp("rank_kernels"))
+    monkeypatch.setattr(click_tracking, "fetch_gsheet", sample_paths.get)
+    monkeypatch.setattr(
+        click_tracking, "get_date_ranges", lambda: get_date_ranges(SAMPLE_TODAY)
+    )
+
+    click_data_df = click_tracking.get_click_data_df()
+    date_range_labels = get_date_range_labels(get_date_ranges(SAMPLE_TODAY))
+    return GEN_DB_DAG.run(
+        {
+            "gsc": make_gsc_df(click_data_df, date_range_labels),
+            "click_data": click_data_df,
+            "date_range_labels": date_range_labels,
+        },
+        ["remove_root_domain_rows", "fill_na_with_zero", "rename_pivot", "combine"],
+        memoize=False,
+    )
+
+
+def test_sample_frames_cover_every_case(sample_frames):
+    merged_df = sample_frames["remove_root_domain_rows"]
+    assert merged_df["clicks"].isna().any()
+    assert (merged_df["in_house_clicks"] > 0).any()
+    assert (merged_df["serpclix_clicks"] > 0).any()
+    ranks = sample_frames["rename_pivot"][RANK_COLUMNS]
+    assert ranks.isna().any(axis=1).any()
+    assert ranks.isna().all(axis=1).any()
+
+
+@pytest.mark.parametrize("node", ["remove_root_domain_rows", "fill_na_with_zero"])
+def test_adjusted_clicks(sample_frames, node):
+    df = sample_frames[node]
+    expected = legacy_adjusted_clicks(to_legacy_dtypes(df))
+    actual = get_adjusted_clicks(df.copy())["adjusted_clicks"]
+    assert_same_values(expected, actual)
+
+
+def test_first_rank(sample_frames):
+    df = sample_frames["rename_pivot"]
+    # Keywords without any rank make create_first_rank_column raise
+    df = df[df[RANK_COLUMNS].notna().any(axis=1)]
+    expected = legacy_first_rank(to_legacy_dtypes(df))
+    actual = create_first_rank_column(df.copy())["first_rank"]
+    assert_same_values(expected, actual)
+
+
+@pytest.mark.parametrize("node", ["rename_pivot", "combine"])
+def test_average_rank(sample_frames, node):
+    df = sample_frames[node]
+    # The legacy kernel warns about the rows without any rank
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        expected = legacy_average_rank(to_legacy_dtypes(df))
+    actual = add_average_rank(df.copy())["average_rank"]
+    assert_same_values(expected, actual)
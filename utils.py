@@ -1,21 +1,142 @@
 import pandas as pd
+import numpy as np
+import csv
 import datetime
 import functools
+import hashlib
+import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from urllib3.util.retry import Retry
 import tldextract
-
-
-def get_date_ranges() -> list:
+import country_converter as coco
+from profiling import profiled
+from replay import REPLAY_MODE
+from replay import REPLAY_OFF
+from replay import REPLAY_RECORD
+from replay import REPLAY_REPLAY
+from replay import record_response
+from replay import replay_response
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+
+# Maximum number of URLs kept in the domain extraction cache
+DOMAIN_CACHE_SIZE = 100000
+
+# Offline extractor: uses the public suffix list snapshot bundled with tldextract
+# and never fetches the list over the network
+_TLD_EXTRACTOR = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+# Formats served from the prebuilt country table, other formats go to country_converter
+COUNTRY_TABLE_FORMATS = ("ISO2", "ISO3", "name_short")
+
+# country_converter instance and name/code table, both built on first use
+_COUNTRY_CONVERTER = None
+_COUNTRY_TABLE = None
+
+# Dtype policy of the pipeline frames, by raw and pretty column name.
+# High-cardinality keys are Arrow-backed strings, repeated labels are categoricals,
+# counts are int32 (float32 while they can be missing) and positions are float32.
+STRING_DTYPE = "string[pyarrow]"
+STRING_COLUMNS = ["query", "page", "Keyword", "Page"]
+CATEGORY_COLUMNS = [
+    "country",
+    "domain",
+    "date_range",
+    "source",
+    "Country",
+    "Domain",
+    "Date Last Updated Interval",
+]
+COUNT_COLUMNS = [
+    "clicks",
+    "impressions",
+    "in_house_clicks",
+    "serpclix_clicks",
+    "adjusted_clicks",
+    "Clicks",
+    "Impressions",
+    "In House Clicks",
+    "SerpClix",
+    "Adjusted Clicks",
+]
+POSITION_COLUMNS = [
+    "position",
+    "current_rank",
+    "previous_rank_1",
+    "previous_rank_2",
+    "previous_rank_3",
+    "previous_rank_4",
+    "previous_rank_5",
+    "first_rank",
+    "average_rank",
+    "Current Rank",
+    "Previous Rank 1",
+    "Previous Rank 2",
+    "Previous Rank 3",
+    "Previous Rank 4",
+    "Previous Rank 5",
+    "Average Position",
+]
+# Google Sheets CSV export endpoint. Point it at a local server to test the downloads
+GSHEET_EXPORT_BASE_URL = os.environ.get(
+    "GSHEET_EXPORT_BASE_URL", "https://docs.google.com/spreadsheets/d"
+)
+# Connect and read timeouts of the sheet downloads, in seconds
+GSHEET_TIMEOUT = (10, 60)
+# Size of the pieces a sheet is streamed to disk in
+GSHEET_CHUNK_BYTES = 64 * 1024
+# Number of connections kept open by the shared download session
+GSHEET_POOL_SIZE = 8
+# Statuses returned by download_gsheet
+GSHEET_CHANGED = "changed"
+GSHEET_UNCHANGED = "unchanged"
+
+# Number of sheets downloaded at the same time by download_gsheets
+GSHEET_MAX_WORKERS = 4
+
+# Shared download session, created on first use
+_GSHEET_SESSION = None
+_GSHEET_SESSION_LOCK = threading.Lock()
+
+# Sheets read by the pipeline, by name: (sheet URL, local CSV path)
+GSHEETS = {}
+# Sheets downloaded by download_gsheets and not read yet, by name: download status
+_PREFETCHED_GSHEETS = {}
+_PREFETCHED_GSHEETS_LOCK = threading.Lock()
+# Sheets read from a local file instead of being downloaded, see use_local_gsheet
+_LOCAL_GSHEETS = set()
+
+# Size of the chunks read by iter_csv_chunks: bytes per block with the pyarrow parser,
+# rows per chunk with the pandas parser
+CSV_CHUNK_BYTES = int(os.environ.get("CSV_CHUNK_BYTES", str(16 * 1024**2)))
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", "100000"))
+
+# Set MEMORY_REPORT_ENABLED=1 to print the before/after memory report of each stage
+MEMORY_REPORT_ENABLED = os.environ.get("MEMORY_REPORT_ENABLED", "0") == "1"
+
+
+def get_date_ranges(today: pd.Timestamp = None) -> list:
     """
     Returns a list of tuples, where each tuple contains two datetime objects that represent the start and end of a date range.
 
+    Parameters:
+    today (pandas.Timestamp): The day the date ranges are computed for. Defaults to today.
+
     Returns:
     list: A list of tuples, where each tuple contains two datetime objects that represent the start and end of a date range.
     """
 
     # Get today's date as a Pandas Timestamp object
-    today = pd.Timestamp.today()
+    today = pd.Timestamp.today() if today is None else pd.Timestamp(today)
 
     # Get the first day of the current month as a Pandas Timestamp object
     first_day_of_month = pd.Timestamp(today.year, today.month, 1)
@@ -49,7 +170,97 @@ def get_date_ranges() -> list:
     return date_ranges
 
 
-def download_gsheet(url: str, path: str = "/path/downloaded_content.csv"):
+def get_date_range_labels(date_ranges: list) -> list:
+    """
+    Returns the "date_range" label of each date range, in the same order.
+
+    Parameters:
+    -----------
+    date_ranges : list
+        A list of tuples, where each tuple contains two datetime objects that represent the start and end of a date range.
+
+    Returns:
+    --------
+    list
+        A list of "start - end" labels formatted as YYYY-MM-DD.
+    """
+    return [
+        f"{date_range[1].date()} - {date_range[0].date()}" for date_range in date_ranges
+    ]
+
+
+def get_gsheet_session() -> requests.Session:
+    """
+    Returns the shared HTTP session of the sheet downloads, creating it on first use.
+
+    The session keeps its connections to Google open between downloads and retries
+    connection errors and transient server errors.
+    """
+    global _GSHEET_SESSION
+    with _GSHEET_SESSION_LOCK:
+        if _GSHEET_SESSION is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=GSHEET_POOL_SIZE,
+                pool_maxsize=GSHEET_POOL_SIZE,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=("GET",),
+                ),
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _GSHEET_SESSION = session
+    return _GSHEET_SESSION
+
+
+def get_gsheet_state_path(path: str) -> str:
+    """
+    Returns the path of the file recording the download state of a sheet.
+    """
+    return f"{path}.state.json"
+
+
+def load_gsheet_state(path: str) -> dict:
+    """
+    Returns the ETag, Last-Modified and content hash recorded for a downloaded sheet.
+
+    Returns:
+    dict: The download state, empty if the sheet was never downloaded.
+    """
+    try:
+        with open(get_gsheet_state_path(path), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_gsheet_hash(path: str):
+    """
+    Returns the sha256 of the last downloaded content of a sheet, or None.
+    """
+    return load_gsheet_state(path).get("sha256")
+
+
+def download_gsheet(url: str, path: str = "/path/downloaded_content.csv") -> str:
+    """
+    Downloads a Google Sheet as CSV, only rewriting the file when its content changed.
+
+    The request is conditional on the ETag and Last-Modified of the previous download,
+    and the body is streamed to disk while it is hashed. The file is only replaced
+    when the hash differs from the previous download. With IO_REPLAY_MODE=record
+    the sheet is captured in the replay archive, and with IO_REPLAY_MODE=replay it is
+    read from the archive instead of Google.
+
+    Parameters:
+    url (str): The URL of the sheet, including its gid.
+    path (str): The path of the CSV file.
+
+    Returns:
+    str: GSHEET_CHANGED, or GSHEET_UNCHANGED when the file already has this content.
+    """
     # Check if the URL is a valid Google Sheets URL
     if "docs.google.com" in url:
         # Extract the document ID and sheet ID from the URL
@@ -57,23 +268,216 @@ def download_gsheet(url: str, path: str = "/path/downloaded_content.csv"):
         sheet_id = url.split("/edit#gid=")[1]
 
         # Construct the CSV download URL
-        csv_url = f"https://docs.google.com/spreadsheets/d/{document_id}/export?format=csv&gid={sheet_id}"
-
-        # Download the CSV file from the URL
-        response = requests.get(csv_url)
+        csv_url = (
+            f"{GSHEET_EXPORT_BASE_URL}/{document_id}/export?format=csv&gid={sheet_id}"
+        )
 
         # Create directories if the path does not exist
         dir_path = os.path.dirname(path)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-
-        # Write the CSV file to the specified path
-        with open(path, "wb") as file:
-            file.write(response.content)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+
+        # Ask for the sheet only if it changed since the last download. A recording
+        # needs the whole sheet, even when it did not change.
+        state = load_gsheet_state(path) if os.path.exists(path) else {}
+        headers = {}
+        if REPLAY_MODE == REPLAY_OFF:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        # Stream the CSV file to a temporary file next to the target, hashing it
+        tmp_path = f"{path}.part"
+        digest = hashlib.sha256()
+        started = time.perf_counter()
+        if REPLAY_MODE == REPLAY_REPLAY:
+            payload = replay_response(["gsheet", document_id, sheet_id])
+            digest.update(payload)
+            with open(tmp_path, "wb") as file:
+                file.write(payload)
+            etag = last_modified = None
+        else:
+            with get_gsheet_session().get(
+                csv_url, headers=headers, timeout=GSHEET_TIMEOUT, stream=True
+            ) as response:
+                if response.status_code == 304:
+                    return GSHEET_UNCHANGED
+                response.raise_for_status()
+                with open(tmp_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=GSHEET_CHUNK_BYTES):
+                        digest.update(chunk)
+                        file.write(chunk)
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+
+        if REPLAY_MODE == REPLAY_RECORD:
+            with open(tmp_path, "rb") as file:
+                record_response(
+                    ["gsheet", document_id, sheet_id],
+                    file.read(),
+                    time.perf_counter() - started,
+                )
+
+        # Keep the file as it is if the content did not change
+        sha256 = digest.hexdigest()
+        if sha256 == state.get("sha256"):
+            os.remove(tmp_path)
+            status = GSHEET_UNCHANGED
+        else:
+            os.replace(tmp_path, path)
+            status = GSHEET_CHANGED
+
+        state_path = get_gsheet_state_path(path)
+        with open(f"{state_path}.tmp", "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "url": csv_url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "sha256": sha256,
+                },
+                file,
+            )
+        os.replace(f"{state_path}.tmp", state_path)
+
+        return status
     else:
         raise ValueError("The provided URL is not a valid Google Sheets URL.")
 
 
+def register_gsheet(name: str, url: str, path: str) -> str:
+    """
+    Registers a sheet read by the pipeline, so download_gsheets fetches it with the others.
+
+    Parameters:
+    name (str): The name of the sheet.
+    url (str): The URL of the sheet, including its gid.
+    path (str): The path of the CSV file.
+
+    Returns:
+    str: The name of the sheet, to pass to fetch_gsheet.
+    """
+    GSHEETS[name] = (url, path)
+    return name
+
+
+def use_local_gsheet(name: str, path: str) -> str:
+    """
+    Reads a registered sheet from a local file instead of downloading it, e.g. for offline runs.
+
+    Parameters:
+    name (str): The name the sheet was registered with.
+    path (str): The path of the local CSV file.
+
+    Returns:
+    str: The name of the sheet.
+    """
+    url, _ = GSHEETS[name]
+    GSHEETS[name] = (url, path)
+    _LOCAL_GSHEETS.add(name)
+    return name
+
+
+@profiled("download_gsheets")
+def download_gsheets(names: list = None, max_workers: int = GSHEET_MAX_WORKERS) -> dict:
+    """
+    Downloads the registered sheets concurrently, at the start of a run.
+
+    The following fetch_gsheet call of each sheet reads the downloaded file instead
+    of downloading it again, so a run waits for the slowest sheet rather than the
+    sum of all of them.
+
+    Parameters:
+    names (list): The sheets to download, every registered sheet by default.
+    max_workers (int): The number of sheets downloaded at the same time.
+
+    Returns:
+    dict: The download status of each sheet.
+    """
+    names = list(GSHEETS) if names is None else names
+    names = [name for name in names if name not in _LOCAL_GSHEETS]
+    if not names:
+        return {}
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_workers, len(names)))
+    ) as executor:
+        futures = {
+            name: executor.submit(download_gsheet, *GSHEETS[name]) for name in names
+        }
+    statuses = {name: future.result() for name, future in futures.items()}
+
+    with _PREFETCHED_GSHEETS_LOCK:
+        _PREFETCHED_GSHEETS.update(statuses)
+    print(f"Sheets: {statuses}")
+    return statuses
+
+
+def fetch_gsheet(name: str) -> str:
+    """
+    Returns the local CSV file of a registered sheet.
+
+    Uses the file downloaded by the last download_gsheets call if it was not read
+    yet, and downloads the sheet otherwise. Local sheets are read as they are.
+
+    Parameters:
+    name (str): The name the sheet was registered with.
+
+    Returns:
+    str: The path of the CSV file.
+    """
+    url, path = GSHEETS[name]
+    if name in _LOCAL_GSHEETS:
+        return path
+    with _PREFETCHED_GSHEETS_LOCK:
+        prefetched = _PREFETCHED_GSHEETS.pop(name, None)
+    if prefetched is None:
+        download_gsheet(url, path)
+    return path
+
+
+def iter_csv_chunks(
+    file_path: str, chunk_bytes: int = CSV_CHUNK_BYTES, chunk_rows: int = CSV_CHUNK_ROWS
+):
+    """
+    Reads a CSV file chunk by chunk, so only one chunk is held in memory at a time.
+
+    Uses pyarrow's streaming CSV reader when pyarrow is installed and pandas' C parser
+    otherwise. Every column is read as strings, so each chunk has the same columns and
+    dtypes whatever values it happens to contain.
+
+    Parameters:
+    file_path (str): The path of the CSV file.
+    chunk_bytes (int): The size of each block read by pyarrow, in bytes.
+    chunk_rows (int): The number of rows of each chunk read by pandas.
+
+    Yields:
+    pandas.DataFrame: The rows of each chunk.
+    """
+    if pa_csv is None:
+        yield from pd.read_csv(
+            file_path, sep=",", encoding="utf-8", dtype=str, chunksize=chunk_rows
+        )
+        return
+
+    with open(file_path, "r", encoding="utf-8", newline="") as file:
+        column_names = next(csv.reader(file), [])
+
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(block_size=chunk_bytes, encoding="utf-8"),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in column_names},
+            strings_can_be_null=True,
+        ),
+    )
+    with reader:
+        for batch in reader:
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+
+
 def convert_to_datetime(df: pd.DataFrame) -> pd.DataFrame:
     """
     Converts a column of dates in a pandas DataFrame to datetime format.
@@ -92,6 +496,67 @@ def convert_to_datetime(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def bucket_dates(dates: pd.Series, date_ranges: list) -> np.ndarray:
+    """
+    Returns the index of the first date range containing each date, or -1 if none does.
+
+    The boundaries of all date ranges are sorted once, and the first matching date range
+    is precomputed for every boundary and for every interval between two boundaries.
+    Each date is then located with a single searchsorted, so overlapping boundaries
+    keep the first-match order of `date_ranges`.
+
+    Parameters:
+    -----------
+    dates : pandas.Series
+        The datetime values to bucket.
+    date_ranges : list
+        A list of tuples, where each tuple contains two datetime objects that represent the start and end of a date range.
+
+    Returns:
+    --------
+    numpy.ndarray
+        The date range index of each date, -1 for dates outside every date range.
+    """
+    # Date ranges are (end, start) tuples, compare them as int64 nanoseconds
+    bounds = [
+        (pd.Timestamp(date_range[1]).value, pd.Timestamp(date_range[0]).value)
+        for date_range in date_ranges
+    ]
+
+    def first_match(value):
+        for i, (start, end) in enumerate(bounds):
+            if start <= value <= end:
+                return i
+        return -1
+
+    boundaries = np.unique(np.array(bounds, dtype=np.int64).ravel())
+    boundary_ids = np.array(
+        [first_match(value) for value in boundaries], dtype=np.int64
+    )
+    # interval_ids[k] is the date range of the values between boundaries[k - 1] and boundaries[k]
+    interval_ids = np.array(
+        [-1]
+        + [
+            first_match(low + (high - low) // 2)
+            for low, high in zip(boundaries[:-1], boundaries[1:])
+        ]
+        + [-1],
+        dtype=np.int64,
+    )
+
+    values = dates.to_numpy(dtype="datetime64[ns]")
+    is_nat = np.isnat(values)
+    values = values.view(np.int64)
+
+    positions = np.searchsorted(boundaries, values, side="left")
+    clipped = np.minimum(positions, len(boundaries) - 1)
+    on_boundary = boundaries[clipped] == values
+    ids = np.where(on_boundary, boundary_ids[clipped], interval_ids[positions])
+    ids[is_nat] = -1
+
+    return ids
+
+
 def add_date_range_column(date_ranges: list, input_df: pd.DataFrame) -> pd.DataFrame:
     """
     Adds a "date_range" column to a pandas DataFrame based on a list of date ranges.
@@ -106,19 +571,18 @@ def add_date_range_column(date_ranges: list, input_df: pd.DataFrame) -> pd.DataF
     Returns:
     --------
     pandas.DataFrame
-        The DataFrame with the added "date_range" column.
+        The rows within a date range, with the added "date_range" column. The column is
+        categorical: its codes are the date range ids and its categories the labels of
+        get_date_range_labels, so no row holds a label string of its own.
     """
 
-    def get_date_range(date, date_ranges):
-        for date_range in date_ranges:
-            if date >= date_range[1] and date <= date_range[0]:
-                return f"{date_range[1].date()} - {date_range[0].date()}"
-        return "N/A"
+    date_range_ids = bucket_dates(input_df["date"], date_ranges)
+    in_date_range = date_range_ids >= 0
 
-    input_df["date_range"] = input_df["date"].apply(
-        lambda date: get_date_range(date, date_ranges)
+    date_range = pd.Categorical.from_codes(
+        date_range_ids[in_date_range], categories=get_date_range_labels(date_ranges)
     )
-    return input_df[input_df["date_range"] != "N/A"]
+    return input_df[in_date_range].assign(date_range=date_range)
 
 
 def drop_date_column(df: pd.DataFrame) -> pd.DataFrame:
@@ -177,9 +641,233 @@ def add_domain_tld_column(df, url_column_name="page", new_column_name="domain"):
     Returns:
     pandas.DataFrame: The updated DataFrame with the new column for domain+TLD
     """
-    # Apply the lambda function to extract the domain and TLD from the URL and add it to the new column
-    df[new_column_name] = df[url_column_name].apply(
-        lambda x: tldextract.extract(x).domain + "." + tldextract.extract(x).suffix
-    )
+    # Extract the domain and TLD from the URL and add it to the new column
+    df[new_column_name] = extract_domains(df[url_column_name])
+
+    return df
+
+
+@functools.lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def extract_domain_parts(url: str) -> tuple:
+    """
+    Extracts the domain, suffix and registered domain of a URL.
+
+    Results are kept in a bounded LRU cache shared by every caller in the process.
+
+    Parameters:
+    url (str): The URL or host to extract the domain from.
+
+    Returns:
+    tuple: The (domain, suffix, registered_domain) of the URL.
+    """
+    extracted = _TLD_EXTRACTOR(url)
+    return extracted.domain, extracted.suffix, extracted.registered_domain
+
+
+def extract_domains(urls: pd.Series, registered: bool = False) -> pd.Series:
+    """
+    Extracts the domain of every URL in a Series, extracting each unique URL only once.
+
+    Parameters:
+    urls (pandas.Series): The URLs to extract the domains from.
+    registered (bool): Return tldextract's registered domain instead of domain + "." + suffix.
+
+    Returns:
+    pandas.Series: The domains, aligned with `urls`. Missing URLs stay missing.
+    """
+    codes, unique_urls = pd.factorize(urls)
+
+    if registered:
+        domains = [extract_domain_parts(url)[2] for url in unique_urls]
+    else:
+        domains = [
+            domain + "." + suffix
+            for domain, suffix, _ in map(extract_domain_parts, unique_urls)
+        ]
+
+    # Look up the domains by code, -1 (missing URL) picks the trailing NaN
+    domains = np.array(domains + [np.nan], dtype=object)
+    return pd.Series(domains[codes], index=urls.index)
+
+
+def get_country_converter() -> coco.CountryConverter:
+    """
+    Returns the shared CountryConverter, creating it on first use.
+    """
+    global _COUNTRY_CONVERTER
+    if _COUNTRY_CONVERTER is None:
+        _COUNTRY_CONVERTER = coco.CountryConverter()
+    return _COUNTRY_CONVERTER
+
+
+def is_plain_country_value(value) -> bool:
+    """
+    Returns whether a country_converter value is a plain name or code, not a regular
+    expression or a missing value.
+    """
+    return isinstance(value, str) and re.fullmatch(r"[\w .,'()-]+", value) is not None
 
+
+def get_country_table() -> dict:
+    """
+    Returns a lowercase name/ISO2/ISO3 -> {ISO2, ISO3, name_short} table, built on first use.
+
+    The table is built from country_converter's own data. Rows whose codes are regular
+    expressions and keys shared by several countries are left out, so every lookup
+    returns what country_converter would return for the same value.
+
+    Returns:
+    dict: The conversions of each lowercase country name and code.
+    """
+    global _COUNTRY_TABLE
+    if _COUNTRY_TABLE is None:
+        table = {}
+        ambiguous_keys = set()
+        country_data = get_country_converter().data
+        columns = list(COUNTRY_TABLE_FORMATS) + ["name_official"]
+        for row in country_data[columns].itertuples(index=False):
+            if not all(
+                is_plain_country_value(getattr(row, column))
+                for column in COUNTRY_TABLE_FORMATS
+            ):
+                continue
+            conversions = {
+                column: getattr(row, column) for column in COUNTRY_TABLE_FORMATS
+            }
+            for key in (row.ISO2, row.ISO3, row.name_short, row.name_official):
+                if not is_plain_country_value(key):
+                    continue
+                key = key.lower()
+                if table.get(key, conversions) != conversions:
+                    ambiguous_keys.add(key)
+                table[key] = conversions
+        for key in ambiguous_keys:
+            del table[key]
+        _COUNTRY_TABLE = table
+    return _COUNTRY_TABLE
+
+
+@functools.lru_cache(maxsize=None)
+def convert_country(name, to: str = "ISO2"):
+    """
+    Converts a single country name or code, remembering the result.
+
+    Known names and codes are served from the prebuilt table; anything else, including
+    unknown values, is converted once with country_converter and cached.
+
+    Parameters:
+    name: The country name or code.
+    to (str): The output format, e.g. 'ISO2' or 'ISO3'.
+
+    Returns:
+    The converted country, or country_converter's "not found" value.
+    """
+    if to in COUNTRY_TABLE_FORMATS and isinstance(name, str):
+        conversions = get_country_table().get(name.lower())
+        if conversions is not None:
+            return conversions[to]
+    return get_country_converter().convert(name, to=to)
+
+
+def convert_countries(countries: pd.Series, to: str = "ISO2") -> pd.Series:
+    """
+    Converts a Series of country names or codes, converting each unique value only once.
+
+    Parameters:
+    countries (pandas.Series): The country names or codes.
+    to (str): The output format, e.g. 'ISO2' or 'ISO3'.
+
+    Returns:
+    pandas.Series: The converted countries, aligned with `countries`. Missing values stay missing.
+    """
+    codes, unique_countries = pd.factorize(countries)
+
+    # Look up the conversions by code, -1 (missing value) picks the trailing NaN
+    converted = np.empty(len(unique_countries) + 1, dtype=object)
+    converted[:] = [convert_country(country, to) for country in unique_countries] + [
+        np.nan
+    ]
+    return pd.Series(converted[codes], index=countries.index)
+
+
+def get_memory_usage(df: pd.DataFrame) -> int:
+    """
+    Returns the memory used by a DataFrame in bytes, including the Python strings it holds.
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+
+def get_compact_dtype(series: pd.Series, column: str):
+    """
+    Returns the dtype of a column under the dtype policy, or None to keep its dtype.
+    """
+    if column in STRING_COLUMNS:
+        return STRING_DTYPE
+    if column in CATEGORY_COLUMNS:
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return None
+        return "category"
+    if column in COUNT_COLUMNS and pd.api.types.is_numeric_dtype(series.dtype):
+        return "float32" if series.isna().any() else "int32"
+    if column in POSITION_COLUMNS and pd.api.types.is_numeric_dtype(series.dtype):
+        return "float32"
+    return None
+
+
+def compact_dtypes(df: pd.DataFrame, stage: str = None) -> pd.DataFrame:
+    """
+    Converts the columns of a DataFrame to the memory-compact dtypes of the dtype policy.
+
+    Columns that already have their compact dtype are left as they are, so the policy
+    can be applied again after every merge, concatenation or pivot.
+
+    Parameters:
+    df (pandas.DataFrame): The DataFrame to convert.
+    stage (str): The pipeline stage, printed with the memory used before and after.
+
+    Returns:
+    pandas.DataFrame: The DataFrame with compact dtypes.
+    """
+    report = stage is not None and MEMORY_REPORT_ENABLED
+    if report:
+        bytes_before = get_memory_usage(df)
+
+    dtypes = {}
+    for column in df.columns:
+        dtype = get_compact_dtype(df[column], column)
+        if dtype is not None and df[column].dtype != dtype:
+            dtypes[column] = dtype
+    if dtypes:
+        df = df.astype(dtypes)
+
+    if report:
+        bytes_after = get_memory_usage(df)
+        print(
+            f"Memory {stage}: {bytes_before / 1024**2:.1f} MB -> "
+            f"{bytes_after / 1024**2:.1f} MB ({len(df)} rows)"
+        )
     return df
+
+
+def align_categories(*dfs: pd.DataFrame) -> list:
+    """
+    Gives the categorical columns shared by several DataFrames the same sorted categories.
+
+    Merges and concatenations only keep a column categorical when its categories are
+    identical on every side, otherwise they fall back to Python object strings.
+
+    Returns:
+    list: The DataFrames, in the same order.
+    """
+    dfs = list(dfs)
+    shared_columns = set.intersection(*(set(df.columns) for df in dfs))
+    for column in sorted(shared_columns):
+        if not all(isinstance(df[column].dtype, pd.CategoricalDtype) for df in dfs):
+            continue
+        categories = sorted(set().union(*(df[column].cat.categories for df in dfs)))
+        dtype = pd.CategoricalDtype(categories)
+        dfs = [
+            df if df[column].dtype == dtype else df.astype({column: dtype})
+            for df in dfs
+        ]
+    return dfs